@@ -0,0 +1,559 @@
+import argparse
+import copy
+import importlib.util
+import json
+import math
+import os
+import re
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import couchbase.search as search
+import couchbase.subdocument as SD
+from flask import jsonify
+from couchbase.exceptions import DocumentExistsException, DocumentNotFoundException, PathNotFoundException
+from couchbase.options import QueryOptions
+
+import travel
+
+# Benchmarks every `/api` endpoint of `travel.py` without a running cluster.
+# The app talks to an in-memory stand-in for the SDK's Cluster, Bucket, Scope
+# and Collection classes, loaded from a small travel-sample fixture, and each
+# stand-in operation can be slowed down to simulate network latency. The
+# requests are made through Flask's test client, so the numbers cover the
+# application code and the (simulated) database round trips, but not HTTP.
+#
+#   python3 benchmark.py --requests 500 --output bench.json
+#   python3 benchmark.py --compare bench.json -- --airport-search query
+#   python3 benchmark.py --json-encoders
+#
+# Options after `--` are passed to `travel.py`.
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark-fixture.json')
+
+
+class Latency:
+    """Simulated round trip time, in seconds, for each kind of operation"""
+
+    def __init__(self, kv=0.0, query=0.0, search=0.0):
+        self.kv = kv
+        self.query = query
+        self.search = search
+
+    def wait(self, kind):
+        delay = getattr(self, kind)
+        if delay:
+            time.sleep(delay)
+
+
+class Content:
+    """Mimics the `content_as[type]` accessor of the SDK's results"""
+
+    def __init__(self, value):
+        self.value = value
+
+    def __getitem__(self, _type):
+        return self.value
+
+
+class StandInResult:
+
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+        self.content_as = Content(copy.deepcopy(value))
+
+
+class StandInLookupResult:
+
+    def __init__(self, values):
+        self.values = values
+        self.content_as = Content(self.read)
+
+    def read(self, index):
+        value = self.values[index]
+        if isinstance(value, Exception):
+            raise value
+        return copy.deepcopy(value)
+
+    def exists(self, index):
+        return self.values[index] is True
+
+
+class StandInCollection:
+    """In-memory stand-in for `couchbase.collection.Collection`"""
+
+    def __init__(self, scope, name):
+        self.scope = scope
+        self.name = name
+        self.documents = scope.bucket.data.setdefault(scope.name, {}).setdefault(name, {})
+        self.lock = threading.Lock()
+
+    def wait(self):
+        self.scope.bucket.latency.wait('kv')
+
+    def get(self, key, *options):
+        self.wait()
+        if key not in self.documents:
+            raise DocumentNotFoundException()
+        return StandInResult(key, self.documents[key])
+
+    def get_multi(self, keys, *options):
+        # The SDK sends every GET at once, so the batch costs one round trip.
+        self.wait()
+        results, exceptions = {}, {}
+        for key in keys:
+            if key in self.documents:
+                results[key] = StandInResult(key, self.documents[key])
+            else:
+                exceptions[key] = DocumentNotFoundException()
+        return SimpleNamespace(results=results, exceptions=exceptions, all_ok=not exceptions)
+
+    def get_any_replica(self, key, *options):
+        return self.get(key)
+
+    def get_any_replica_multi(self, keys, *options):
+        return self.get_multi(keys)
+
+    def insert(self, key, value, *options):
+        self.wait()
+        with self.lock:
+            if key in self.documents:
+                raise DocumentExistsException()
+            self.documents[key] = copy.deepcopy(value)
+
+    def upsert(self, key, value, *options):
+        self.wait()
+        with self.lock:
+            self.documents[key] = copy.deepcopy(value)
+
+    def upsert_multi(self, documents, *options):
+        self.wait()
+        with self.lock:
+            for key, value in documents.items():
+                self.documents[key] = copy.deepcopy(value)
+        return SimpleNamespace(results={key: True for key in documents}, exceptions={}, all_ok=True)
+
+    def remove_multi(self, keys, *options):
+        self.wait()
+        results, exceptions = {}, {}
+        with self.lock:
+            for key in keys:
+                if self.documents.pop(key, None) is None:
+                    exceptions[key] = DocumentNotFoundException()
+                else:
+                    results[key] = True
+        return SimpleNamespace(results=results, exceptions=exceptions, all_ok=not exceptions)
+
+    def lookup_in(self, key, specs, *options):
+        self.wait()
+        if key not in self.documents:
+            raise DocumentNotFoundException()
+        document = self.documents[key]
+        values = []
+        for spec in specs:
+            op, path = spec[0], spec[1]
+            if op == SD.SubDocOp.EXISTS:
+                values.append(path in document)
+            elif path in document:
+                values.append(document[path])
+            else:
+                values.append(PathNotFoundException())
+        return StandInLookupResult(values)
+
+    def mutate_in(self, key, specs, *options):
+        self.wait()
+        with self.lock:
+            if key not in self.documents:
+                raise DocumentNotFoundException()
+            document = self.documents[key]
+            for spec in specs:
+                op, path = spec[0], spec[1]
+                if op == SD.SubDocOp.ARRAY_PUSH_LAST:
+                    document.setdefault(path, []).extend(spec[-1])
+                elif op in (SD.SubDocOp.DICT_UPSERT, SD.SubDocOp.REPLACE, SD.SubDocOp.DICT_ADD):
+                    document[path] = spec[-1]
+                else:
+                    raise ValueError(f"The stand-in cluster does not support the sub-document operation {op.name} "
+                                     f"on path {path!r} of {key!r}")
+
+
+class StandInScope:
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    def collection(self, name):
+        return self.bucket.handles.setdefault((self.name, name), StandInCollection(self, name))
+
+
+class StandInBucket:
+    """In-memory stand-in for `couchbase.bucket.Bucket`, holding {scope: {collection: {key: doc}}}"""
+
+    def __init__(self, data, latency):
+        self.name = 'travel-sample'
+        self.data = data
+        self.latency = latency
+        self.handles = {}
+
+    def scope(self, name):
+        return StandInScope(self, name)
+
+    def collections(self):
+        return SimpleNamespace(get_all_scopes=lambda *options: [SimpleNamespace(name=name) for name in self.data])
+
+
+class StandInCluster:
+    """In-memory stand-in for `couchbase.cluster.Cluster`
+
+    Only the SQL++ statements and search queries made by `travel.py` are
+    understood; they are recognised by their shape and answered from the
+    inventory collections of the bucket.
+    """
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def wait_until_ready(self, timeout, *options):
+        pass
+
+    def inventory(self, collection):
+        return self.bucket.data['inventory'][collection].values()
+
+    def query(self, statement, *args, **kwargs):
+        self.bucket.latency.wait('query')
+        args = [arg for arg in args if not isinstance(arg, QueryOptions)]
+        statement = ' '.join(statement.split())
+        airports = self.bucket.data['inventory']['airport']
+
+        if 'UNNEST r.schedule' in statement:
+            airlines = self.bucket.data['inventory']['airline']
+            rows = []
+            for route in self.inventory('route'):
+                if 'WHERE' in statement and (route['sourceairport'] != kwargs['fromfaa'] or
+                                             route['destinationairport'] != kwargs['tofaa']):
+                    continue
+                for flight in route['schedule']:
+                    if 'WHERE' in statement and flight['day'] != kwargs['dayofweek']:
+                        continue
+                    row = {'name': airlines[route['airlineid']]['name'], 'flight': flight['flight'],
+                           'utc': flight['utc'], 'sourceairport': route['sourceairport'],
+                           'destinationairport': route['destinationairport'], 'equipment': route['equipment']}
+                    if 'WHERE' not in statement:
+                        row['day'] = flight['day']
+                    rows.append(row)
+            if 'ORDER BY a.name' in statement:
+                rows.sort(key=lambda row: row['name'])
+        elif 'airportname IN $1' in statement:
+            rows = [{'airportname': a['airportname'], 'faa': a['faa']} for a in airports.values()
+                    if a['airportname'] in args[0]]
+        elif re.search(r'WHERE (POSITION\(LOWER\(airportname\), \$1\) = 0|faa=\$1|icao=\$1)', statement):
+            field = re.search(r'WHERE (POSITION|faa|icao)', statement).group(1)
+            rows = []
+            for key, a in airports.items():
+                if a[field] == args[0] if field != 'POSITION' else a['airportname'].lower().startswith(args[0]):
+                    row = {'airportname': a['airportname']}
+                    if 'AS cursor' in statement:
+                        row['cursor'] = [a['airportname'].lower(), a['airportname'], key]
+                    rows.append(row)
+            if '> $2' in statement:
+                rows = [row for row in rows if row['cursor'] > args[1]]
+            if 'ORDER BY' in statement:
+                rows.sort(key=lambda row: row['cursor'])
+            if 'LIMIT' in statement:
+                rows = rows[:args[int(re.search(r'LIMIT \$(\d+)', statement).group(1)) - 1]]
+        elif 'LET distance' in statement:
+            rows = []
+            for a in airports.values():
+                distance = haversine(kwargs['lat'], kwargs['lon'], a['geo'])
+                if not kwargs['radius'] or distance <= kwargs['radius']:
+                    rows.append({**{f: a.get(f) for f in ('airportname', 'faa', 'icao', 'city', 'country')},
+                                 'distance': distance})
+            rows = sorted(rows, key=lambda row: row['distance'])[:kwargs['k']]
+        elif statement.endswith('WHERE geo IS VALUED'):
+            collection = re.search(r'inventory\.(\w+)', statement).group(1)
+            rows = [copy.deepcopy(document) for document in self.inventory(collection) if document.get('geo')]
+        elif statement.startswith('SELECT airportname, faa, icao'):
+            rows = [{'airportname': a['airportname'], 'faa': a['faa'], 'icao': a['icao'], 'id': key}
+                    for key, a in airports.items()]
+        else:
+            raise ValueError(f"The stand-in cluster does not support the SQL++ statement: {statement}")
+        return iter(rows)
+
+    def search_query(self, index, query, options=None):
+        self.bucket.latency.wait('search')
+        options = options or {}
+        fields = options.get('fields') or []
+        rows = []
+        hotels = self.bucket.data['inventory']['hotel']
+        for key, hotel in sorted(hotels.items()):
+            if matches(query.encodable, hotel):
+                # Every hit scores the same, so the ['-_score', '_id'] sort
+                # used for paging orders them by key.
+                rows.append(SimpleNamespace(id=key, score=1.0, sort=['1.0', key],
+                                            fields={f: hotel[f] for f in fields if f in hotel}))
+        for sort in options.get('sort') or []:
+            if isinstance(sort, search.SortGeoDistance):
+                lon, lat = sort.location
+                rows.sort(key=lambda row: haversine(lat, lon, hotels[row.id]['geo']))
+        after = (options.get('raw') or {}).get('search_after')
+        if after:
+            rows = [row for row in rows if row.sort > after]
+        return iter(rows[:options.get('limit') or len(rows)])
+
+
+def matches(query, document):
+    """Evaluates the conjunction/disjunction/match-phrase queries built by `travel.py`"""
+    if 'conjuncts' in query:
+        return all(matches(q, document) for q in query['conjuncts'])
+    if 'disjuncts' in query:
+        return any(matches(q, document) for q in query['disjuncts'])
+    if 'match_phrase' in query:
+        return query['match_phrase'].lower() in str(document.get(query['field'], '')).lower()
+    if 'distance' in query:
+        lon, lat = query['location']
+        return query['field'] in document and \
+            haversine(lat, lon, document[query['field']]) <= float(query['distance'].rstrip('km'))
+    raise ValueError(f"The stand-in cluster does not support the search query {query!r}, only conjunction, "
+                     f"disjunction, match phrase and geo distance queries")
+
+
+def haversine(lat, lon, geo):
+    """Returns the great-circle distance in km from a location to a `geo` field"""
+    lat1, lat2 = math.radians(lat), math.radians(geo['lat'])
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin(math.radians(geo['lon'] - lon) / 2) ** 2
+    return 2 * travel.earthRadius * math.asin(math.sqrt(a))
+
+
+def standin(latency, fixture=FIXTURE):
+    with open(fixture) as f:
+        data = json.load(f)
+    bucket = StandInBucket(data, latency)
+    return StandInCluster(bucket), bucket
+
+
+# Each scenario returns the arguments for one request to the test client.
+
+def scenarios(fixture):
+    with open(fixture) as f:
+        inventory = json.load(f)['inventory']
+    airportNames = sorted(a['airportname'] for a in inventory['airport'].values())
+    searches = [name[:n] for name in airportNames for n in (1, 3, 6)] + \
+               [a['faa'] for a in inventory['airport'].values() if a['faa']] + \
+               [a['icao'] for a in inventory['airport'].values() if a['icao']]
+    faa = {a['faa']: a['airportname'] for a in inventory['airport'].values() if a['faa']}
+    routes = [(faa[r['sourceairport']], faa[r['destinationairport']]) for r in inventory['route'].values()]
+    hotels = [('pool', '*'), ('*', 'San Francisco'), ('pool', 'San Francisco'), ('breakfast', 'Paris'),
+              ('hotel', 'United States'), ('wifi', '*')]
+    locations = [(h['geo']['lat'], h['geo']['lon']) for h in inventory['hotel'].values() if h.get('geo')]
+    flight = {'name': 'American Airlines', 'flight': 'AA331', 'price': 152.5, 'date': '05/24/2021',
+              'sourceairport': 'SFO', 'destinationairport': 'LAX'}
+
+    def token(user):
+        return {'Authorization': 'Bearer ' + travel.genToken(user)}
+
+    def counter():
+        n = 0
+        lock = threading.Lock()
+
+        def next_():
+            nonlocal n
+            with lock:
+                n += 1
+                return n
+        return next_
+
+    count = counter()
+    return {
+        'airports': lambda: ('GET', f"/api/airports?search={searches[count() % len(searches)]}", {}),
+        'flightPaths': lambda: ('GET', "/api/flightPaths/{}/{}?leave=05/{:02d}/2021".format(
+            *routes[count() % len(routes)], count() % 28 + 1), {}),
+        'login': lambda: ('POST', '/api/tenants/tenant_agent_00/user/login',
+                          {'json': {'user': 'user1', 'password': 'password1'}}),
+        'signup': lambda: ('POST', '/api/tenants/tenant_agent_00/user/signup',
+                           {'json': {'user': f"bench-{uuid.uuid4()}", 'password': 'password'}}),
+        'updateflights': lambda: ('PUT', '/api/tenants/tenant_agent_00/user/user1/flights',
+                                  {'json': {'flights': [flight]}, 'headers': token('user1')}),
+        'getflights': lambda: ('GET', '/api/tenants/tenant_agent_00/user/user1/flights',
+                               {'headers': token('user1')}),
+        'hotels': lambda: ('GET', "/api/hotels/{}/{}/".format(*hotels[count() % len(hotels)]), {}),
+        'nearbyairports': lambda: ('GET', "/api/airports/nearby?lat={}&lon={}&k=5".format(
+            *locations[count() % len(locations)]), {}),
+        'nearbyhotels': lambda: ('GET', "/api/hotels/nearby?lat={}&lon={}&k=10&radius=50".format(
+            *locations[count() % len(locations)]), {}),
+    }
+
+
+def percentile(sortedValues, p):
+    index = min(len(sortedValues) - 1, max(0, round(p / 100 * len(sortedValues)) - 1))
+    return sortedValues[index]
+
+
+def run(client, name, scenario, requests, concurrency):
+    """Returns throughput and latency percentiles for one endpoint"""
+    latencies = []
+    errors = 0
+
+    def one(_):
+        method, url, kwargs = scenario()
+        start = time.perf_counter()
+        response = client.open(url, method=method, **kwargs)
+        elapsed = time.perf_counter() - start
+        return elapsed, response.status_code
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for elapsed, status in pool.map(one, range(requests)):
+            latencies.append(elapsed)
+            if status >= 400:
+                errors += 1
+    duration = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': requests,
+        'errors': errors,
+        'throughput': round(requests / duration, 1),
+        'mean_ms': round(statistics.mean(latencies) * 1000, 3),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+    }
+
+
+# The largest airports response of the full travel-sample bucket lists every
+# one of its 1968 airports, and a hotels response holds at most a page of 100.
+
+payloadSizes = {'airports': 1968, 'hotels': 100}
+
+
+def payloads(fixture):
+    """Returns airports and hotels response bodies of `payloadSizes` rows, made from the fixture"""
+    with open(fixture) as f:
+        inventory = json.load(f)['inventory']
+    airports = [{'airportname': a['airportname']} for a in inventory['airport'].values()]
+    hotels = [{'name': h['name'], 'description': h['description'],
+               'address': ', '.join(h[field] for field in ('address', 'city', 'state', 'country') if h.get(field))}
+              for h in inventory['hotel'].values()]
+    return {
+        'airports': {'data': [airports[n % len(airports)] for n in range(payloadSizes['airports'])],
+                     'context': ["SQL++ query - scoped to inventory: SELECT airportname FROM "
+                                 "`travel-sample`.inventory.airport WHERE POSITION(LOWER(airportname), $1) = 0"]},
+        'hotels': {'data': [hotels[n % len(hotels)] for n in range(payloadSizes['hotels'])],
+                   'context': ["FTS search - scoped to: inventory.hotel within fields "
+                               "address,city,state,country,name,description"]},
+    }
+
+
+def encoders(app, fixture, rounds):
+    """Returns the time to encode each payload with each `--json-encoder`, checking the bytes match"""
+    results = {}
+    with app.test_request_context():
+        for payload, body in payloads(fixture).items():
+            results[payload] = {}
+            expected = None
+            for name, encoder in travel.jsonEncoders.items():
+                if name != 'stdlib' and importlib.util.find_spec(name) is None:
+                    continue
+                travel.fastencode = encoder()
+                encoded = jsonify(body).get_data()
+                expected = encoded if expected is None else expected
+                started = time.perf_counter()
+                for _ in range(rounds):
+                    jsonify(body).get_data()
+                results[payload][name] = {'bytes': len(encoded), 'identical': encoded == expected,
+                                          'us': round((time.perf_counter() - started) / rounds * 1e6, 1)}
+    travel.fastencode = travel.jsonEncoders[travel.args.json_encoder]()
+    return results
+
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results, baseline=None):
+    print(f"{'endpoint':<14}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for name, result in results['endpoints'].items():
+        line = f"{name:<14}{result['throughput']:>10}{result['p50_ms']:>10}{result['p95_ms']:>10}" \
+               f"{result['p99_ms']:>10}{result['errors']:>8}"
+        previous = (baseline or {}).get('endpoints', {}).get(name)
+        if previous:
+            change = (result['p50_ms'] - previous['p50_ms']) / previous['p50_ms'] * 100 if previous['p50_ms'] else 0
+            line += f"   p50 {change:+.1f}% vs {baseline.get('commit') or 'baseline'}"
+        print(line)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    appArgs = []
+    if '--' in argv:
+        appArgs = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+
+    parser = argparse.ArgumentParser(description='Benchmark the travel-sample API against an in-memory cluster')
+    parser.add_argument('-n', '--requests', help='Requests per endpoint', type=int, default=200)
+    parser.add_argument('-c', '--concurrency', help='Requests in flight at once', type=int, default=1)
+    parser.add_argument('-e', '--endpoints', help='Comma separated endpoints to run (default: all)')
+    parser.add_argument('--kv-latency', help='Simulated KV round trip in ms', type=float, default=0.0)
+    parser.add_argument('--query-latency', help='Simulated SQL++ round trip in ms', type=float, default=0.0)
+    parser.add_argument('--search-latency', help='Simulated FTS round trip in ms', type=float, default=0.0)
+    parser.add_argument('--fixture', help='Fixture holding the stand-in bucket', default=FIXTURE)
+    parser.add_argument('-o', '--output', help='Write the results as JSON to this file')
+    parser.add_argument('--compare', help='Compare with the JSON results of an earlier run')
+    parser.add_argument('--json-encoders', help='Time each --json-encoder on the largest airports and hotels '
+                        'responses instead of the endpoints', action='store_true')
+    options = parser.parse_args(argv)
+
+    latency = Latency(options.kv_latency / 1000, options.query_latency / 1000, options.search_latency / 1000)
+    cluster, bucket = standin(latency, options.fixture)
+    travel.connect_db = lambda: (cluster, bucket)
+
+    app = travel.create_app(['-u', 'benchmark', '-p', 'benchmark', *appArgs])
+    if options.json_encoders:
+        results = encoders(app, options.fixture, options.requests)
+        print(f"{'payload':<10}{'encoder':<10}{'bytes':>10}{'us':>10}{'speedup':>10}  identical")
+        for payload, timings in results.items():
+            for name, timing in timings.items():
+                print(f"{payload:<10}{name:<10}{timing['bytes']:>10}{timing['us']:>10}"
+                      f"{timings['stdlib']['us'] / timing['us']:>9.1f}x  {timing['identical']}")
+        return results
+    travel.connect_worker()
+    client = app.test_client()
+
+    allScenarios = scenarios(options.fixture)
+    names = options.endpoints.split(',') if options.endpoints else list(allScenarios)
+
+    results = {'commit': commit(), 'app_args': appArgs, 'requests': options.requests,
+               'concurrency': options.concurrency,
+               'latency_ms': {'kv': options.kv_latency, 'query': options.query_latency,
+                              'search': options.search_latency},
+               'endpoints': {}}
+    for name in names:
+        results['endpoints'][name] = run(client, name, allScenarios[name], options.requests, options.concurrency)
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
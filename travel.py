@@ -1,23 +1,55 @@
 import argparse
+import base64
+import importlib.util
+import bisect
+import hashlib
+import heapq
+import hmac
+import json
 import math
+import os
+import re
+import sys
+import threading
+import time
 import uuid
+import zlib
+
+# Cold start is measured from here, so that the time spent importing Flask,
+# the Couchbase SDK and the rest is included in what `/metrics` reports.
+importStarted = time.perf_counter()
+
 import jwt  # from PyJWT
-from datetime import datetime
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
 from random import random
-from flasgger import Swagger, SwaggerView
-from flask import Flask, jsonify, make_response, request
+from flask import Flask, g, has_request_context, jsonify, make_response, request, stream_with_context
 from flask.blueprints import Blueprint
-from flask_classy import FlaskView
+from flask.json import JSONEncoder
 from flask_cors import CORS, cross_origin
 
 # Couchbase Imports
-import couchbase.search as FT
 import couchbase.subdocument as SD
 from couchbase.cluster import Cluster
-from couchbase.options import ClusterOptions, SearchOptions
+from couchbase.diagnostics import ServiceType
+from couchbase.n1ql import QueryScanConsistency
+from couchbase.options import (ClusterOptions, GetAnyReplicaMultiOptions, GetAnyReplicaOptions, GetMultiOptions,
+                               GetOptions, IncrementOptions, InsertOptions, LookupInOptions, MutateInOptions,
+                               QueryOptions, SearchOptions, SignedInt64, UpsertMultiOptions, UpsertOptions,
+                               WaitUntilReadyOptions)
 from couchbase.auth import PasswordAuthenticator
+from couchbase.management.options import GetAllScopesOptions
+from couchbase.transcoder import RawJSONTranscoder
 from couchbase.exceptions import *
 
+# flasgger, and the jsonschema and YAML parsers it pulls in, is the slowest
+# import of all, so it is only imported once the API docs are asked for (see
+# `--apidocs`). Likewise `couchbase.search` is imported by the first hotel
+# search rather than at startup.
+
+importSeconds = time.perf_counter() - importStarted
+
 # From Couchbase Server 5.0 onward, there must be a username and password.
 # User must have full access to read/write bucket/data and read access for
 # Query and Search.
@@ -38,30 +70,152 @@ from couchbase.exceptions import *
 JWT_SECRET = 'cbtravelsample'
 
 parser = argparse.ArgumentParser()
-parser.add_argument('-c', '--cluster', help='Connection String i.e. localhost', default='db')
+parser.add_argument('-c', '--cluster', help='Connection String i.e. localhost', default=os.environ.get('CB_HOST', 'db'))
 parser.add_argument('-s', '--scheme', help='couchbase or couchbases', default='couchbase')
 parser.add_argument('-a', '--connectargs', help="?any_additional_args", default="")
-parser.add_argument('-u', '--user', help='User with access to bucket')
-parser.add_argument('-p', '--password', help='Password of user with access to bucket')
+parser.add_argument('-u', '--user', help='User with access to bucket', default=os.environ.get('CB_USER'))
+parser.add_argument('-p', '--password', help='Password of user with access to bucket',
+                    default=os.environ.get('CB_PSWD'))
+parser.add_argument('--airport-search', help='Airport autocomplete backend: in-memory prefix index or SQL++ query',
+                    choices=['index', 'query'], default='index')
+parser.add_argument('--airport-limit', help='Maximum number of airports returned by the prefix index (0 = no limit)',
+                    type=int, default=0)
+parser.add_argument('--query-mode', help='Send SQL++ statements as ad-hoc queries, or prepare each one once',
+                    choices=['adhoc', 'prepared'], default='prepared')
+parser.add_argument('--route-search', help='Flight path backend: precomputed route index or SQL++ query',
+                    choices=['index', 'query'], default='index')
+parser.add_argument('--route-ttl', help='Seconds before the route index is rebuilt (0 = only on refresh)',
+                    type=int, default=0)
+parser.add_argument('--faa-cache-size', help='Number of airport name to FAA code mappings to cache',
+                    type=int, default=1024)
+parser.add_argument('--faa-cache-ttl', help='Seconds an airport name to FAA code mapping is cached (0 = forever)',
+                    type=int, default=3600)
+parser.add_argument('--hotel-search', help='Where hotel search results get their fields: stored in the FTS index, '
+                    'or a sub-document lookup per hit', choices=['stored', 'lookup'], default='stored')
+parser.add_argument('--geo-search', help='Nearby airport and hotel backend: in-memory spatial index, or SQL++ and FTS '
+                    'geo queries', choices=['index', 'service'], default='index')
+parser.add_argument('--hotel-lookup-workers', help='Number of hotel sub-document lookups issued concurrently',
+                    type=int, default=16)
+parser.add_argument('--hedge', help='Also read from a replica when a login or flight list read from the active node is '
+                    'slow, and use the first answer', choices=['off', 'replica'], default='off')
+parser.add_argument('--hedge-percentile', help='Percentile of recent active read times after which a read is hedged',
+                    type=float, default=95.0)
+parser.add_argument('--hedge-delay', help='Milliseconds after which a read is hedged until enough reads have been timed',
+                    type=float, default=20.0)
+parser.add_argument('--hedge-workers', help='Number of active and replica reads issued concurrently when hedging',
+                    type=int, default=16)
+parser.add_argument('--hotel-cache', help='Hotel search response cache: none, in-process, or shared through Couchbase',
+                    choices=['none', 'memory', 'couchbase'], default='memory')
+parser.add_argument('--hotel-cache-size', help='Number of hotel search responses cached in-process',
+                    type=int, default=1000)
+parser.add_argument('--hotel-cache-bytes', help='Total bytes of hotel search responses cached in-process',
+                    type=int, default=64 * 1024 * 1024)
+parser.add_argument('--hotel-cache-ttl', help='Seconds a hotel search response is cached',
+                    type=int, default=300)
+parser.add_argument('--hotel-cache-collection', help='SCOPE.COLLECTION of travel-sample holding the shared hotel cache',
+                    default='cache.hotels')
+parser.add_argument('--admin-token', help='Bearer token of the operator endpoints, which are disabled without one',
+                    default=os.environ.get('TRAVEL_ADMIN_TOKEN'))
+parser.add_argument('--token-ttl', help='Seconds a login token is valid for', type=int, default=86400)
+parser.add_argument('--token-cache-size', help='Number of verified login tokens cached', type=int, default=10000)
+parser.add_argument('--responses', help='Encode airport, flight path and hotel results all at once, or stream them '
+                    'row by row as they are read', choices=['buffered', 'streamed'], default='buffered')
+parser.add_argument('--json-encoder', help='Encoder of compact JSON response bodies: the standard library, or orjson',
+                    choices=['stdlib', 'orjson'], default='stdlib')
+parser.add_argument('--compression', help='Comma separated encodings /api responses may be compressed with, in order '
+                    'of preference when a client accepts several; br and zstd need the brotli and zstandard packages',
+                    default='zstd,br,gzip')
+parser.add_argument('--compression-min-size', help='Smallest /api response body, in bytes, that is compressed',
+                    type=int, default=1024)
+parser.add_argument('--compression-level', help='Compression level, limited to the highest level of each encoding',
+                    type=int, default=6)
+parser.add_argument('--cache-max-age', help='Seconds browsers and CDNs may reuse an airport or hotel response, which '
+                    'also carries an ETag (0 = neither)', type=int, default=60)
+parser.add_argument('--collection-cache-size', help='Number of scope/collection handles kept for reuse',
+                    type=int, default=256)
+parser.add_argument('--tenants', help='Comma separated tenant scopes whose collection handles are opened at startup',
+                    default='')
+parser.add_argument('--route-concurrency', help='Requests handled at once per /api route by each process, 0 for no limit',
+                    type=int, default=0)
+parser.add_argument('--tenant-concurrency', help='Requests handled at once per tenant by each process, 0 for no limit',
+                    type=int, default=0)
+parser.add_argument('--admission-queue', help='Requests that may wait for a route at its limit before more are '
+                    'rejected; the production server leaves at least one of --threads free', type=int, default=8)
+parser.add_argument('--admission-wait', help='Seconds a request waits for a route at its limit before it is rejected',
+                    type=float, default=1.0)
+parser.add_argument('--deadline', help='Time budget of an /api view as VIEW=SECONDS, e.g. hotels=2.5, replacing its '
+                    'default in routeDeadlines; may be repeated, and 0 removes the deadline', action='append',
+                    default=[], metavar='VIEW=SECONDS')
+parser.add_argument('--ready-timeout', help='Seconds to wait for the KV, query and search services when connecting, '
+                    '0 to not wait', type=int, default=60)
+parser.add_argument('--warmup', help='Run an airport, flight path and hotel search before reporting ready',
+                    choices=['requests', 'none'], default='requests')
+parser.add_argument('--apidocs', help='Serve the API docs from the prebuilt swagger.json, building Swagger UI on its '
+                    'first request, or generate them from the view docstrings at startup',
+                    choices=['prebuilt', 'generated'], default='prebuilt')
+parser.add_argument('--server', help='Flask development server, or a production server with several worker processes',
+                    choices=['dev', 'production'], default='dev')
+parser.add_argument('--workers', help='Number of worker processes for the production server',
+                    type=int, default=os.cpu_count() or 1)
+parser.add_argument('--threads', help='Number of threads per worker process for the production server',
+                    type=int, default=4)
+parser.add_argument('--port', help='Port to serve the API on', type=int, default=8080)
+
+# The options are parsed by `configure`, which `create_app` calls. Until then
+# `args` holds the defaults, and it is updated in place so that other modules
+# importing it see the parsed values.
+
+args = parser.parse_args([])
+CONNSTR = None
+authenticator = None
+
+
+def configure(argv=()):
+    """Parses the options in argv and sets the connection parameters"""
+    global CONNSTR, authenticator, fastencode, encodings
+    parser.parse_args(argv, namespace=args)
+    fastencode = jsonEncoders[args.json_encoder]()
+    encodings = availableencodings(args.compression)
+
+    deadlines.clear()
+    deadlines.update(routeDeadlines)
+    for deadline in args.deadline:
+        view, _, seconds = deadline.partition('=')
+        try:
+            deadlines[view] = float(seconds)
+        except ValueError:
+            parser.error(f"--deadline must be VIEW=SECONDS, not {deadline}")
+        if view not in routeDeadlines:
+            parser.error(f"--deadline view must be one of {', '.join(routeDeadlines)}")
 
-args = parser.parse_args()
+    scope, _, name = args.hotel_cache_collection.partition('.')
+    if not (CollectionHandles.scopeName.match(scope) and CollectionHandles.scopeName.match(name)):
+        parser.error(f"--hotel-cache-collection must be SCOPE.COLLECTION, not {args.hotel_cache_collection}")
 
-# Init CB connection parameters
+    # Init CB connection parameters
 
-if not args.cluster:
-  raise ConnectionError("No value for CB_HOST set!")
-if not args.user:
-    raise ConnectionError("No value for CB_USER set!")
-if not args.password:
-    raise ConnectionError("No value for CB_PSWD set!")
+    if not args.cluster:
+      raise ConnectionError("No value for CB_HOST set!")
+    if not args.user:
+        raise ConnectionError("No value for CB_USER set!")
+    if not args.password:
+        raise ConnectionError("No value for CB_PSWD set!")
+
+    if ("couchbases://" in args.cluster) or ("couchbase://" in args.cluster):
+        CONNSTR = f"{args.cluster}{args.connectargs}"
+    else:
+        CONNSTR = f"{args.scheme}://{args.cluster}{args.connectargs}"
+
+    authenticator = PasswordAuthenticator(args.user, args.password)
+    print("Connecting to: " + CONNSTR)
+
+    faaCache.maxsize = args.faa_cache_size
+    faaCache.ttl = args.faa_cache_ttl
+    tokenCache.maxsize = issuedTokenCache.maxsize = args.token_cache_size
+    tokenCache.ttl = args.token_ttl
+    issuedTokenCache.ttl = args.token_ttl / 2
+    collectionHandles.handles.maxsize = args.collection_cache_size
 
-if ("couchbases://" in args.cluster) or ("couchbase://" in args.cluster):
-	CONNSTR = f"{args.cluster}{args.connectargs}"
-else:
-	CONNSTR = f"{args.scheme}://{args.cluster}{args.connectargs}"
-        
-authenticator = PasswordAuthenticator(args.user, args.password)
-print("Connecting to: " + CONNSTR)
 
 # Initialise the web app
 app = Flask(__name__)
@@ -82,6 +236,11 @@ swagger_template = {
                 "scheme": "bearer",
                 "bearerFormat": "JWT",
                 "description": "JWT Authorization header using the Bearer scheme."
+            },
+            "operator": {
+                "type": "http",
+                "scheme": "bearer",
+                "description": "Operator token set with --admin-token."
             }
         },
         "schemas": {
@@ -122,6 +281,46 @@ swagger_template = {
 }
 
 
+class PrebuiltApiDocs:
+    """WSGI middleware serving the API docs from the prebuilt `swagger.json`
+
+    The spec is read once and served as is from `/apispec_1.json`. Swagger UI
+    is a separate small Flask app, created with flasgger on the first request
+    for `/apidocs` or its static files, so that neither flasgger nor the view
+    docstrings are parsed while the backend is starting up.
+    """
+
+    prefixes = ('/apidocs', '/flasgger_static')
+
+    def __init__(self, wsgiApp, path):
+        with open(path, 'rb') as specFile:
+            self.spec = specFile.read()
+        self.wsgiApp = wsgiApp
+        self.docs = None
+        self.lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if path == '/apispec_1.json':
+            start_response('200 OK', [('Content-Type', 'application/json'),
+                                      ('Content-Length', str(len(self.spec)))])
+            return [self.spec]
+        if path.startswith(self.prefixes):
+            return self.swaggerui()(environ, start_response)
+        return self.wsgiApp(environ, start_response)
+
+    def swaggerui(self):
+        if self.docs is None:
+            with self.lock:
+                if self.docs is None:
+                    from flasgger import Swagger
+                    docs = Flask(__name__)
+                    docs.config['SWAGGER'] = app.config['SWAGGER']
+                    Swagger(docs, template=json.loads(self.spec))
+                    self.docs = docs
+        return self.docs
+
+
 api = Blueprint("api", __name__)
 
 CORS(app, headers=['Content-Type', 'Authorization'])
@@ -152,7 +351,1124 @@ def index():
 def lowercase(key):
     return key.lower()
 
-class AirportView(SwaggerView):
+
+class Metrics:
+    """Latency histograms, counters and gauges in the Prometheus text format
+
+    Each series is keyed by its metric name and a tuple of (label, value)
+    pairs. Observations only take a lock and bump a few numbers, so they are
+    cheap enough to leave on; the text is rendered when `/metrics` is read.
+    Every worker process keeps its own series.
+    """
+
+    buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    descriptions = {
+        'travel_http_request_duration_seconds': ('histogram', 'Time to handle a request, by route'),
+        'travel_http_requests_total': ('counter', 'Requests handled, by route and status'),
+        'travel_http_request_errors_total': ('counter', 'Requests that failed with a 5xx status, by route'),
+        'travel_http_requests_in_flight': ('gauge', 'Requests being handled, by route'),
+        'travel_operation_duration_seconds': ('histogram', 'Time spent in Couchbase, JWT and JSON operations'),
+        'travel_operation_errors_total': ('counter', 'Operations that raised an exception'),
+        'travel_operations_in_flight': ('gauge', 'Operations in progress'),
+        'travel_query_plans_total': ('counter', 'Prepared SQL++ statements run, by whether this process had '
+                                               'prepared them before (hit) or not (miss)'),
+        'travel_admission_rejections_total': ('counter', 'Requests rejected because their route or tenant was at its '
+                                                         'concurrency limit with a full queue, or stayed so too long'),
+        'travel_hedges_fired_total': ('counter', 'Reads for which a replica read was issued as the active read was slow'),
+        'travel_hedges_won_total': ('counter', 'Hedged reads answered by the replica before the active node'),
+        'travel_hedge_delay_seconds': ('gauge', 'Current delay before a read is hedged'),
+        'travel_startup_seconds': ('gauge', 'Time from the start of the module import to the end of each startup '
+                                            'phase: imports done, app configured, ready and first response'),
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def observe(self, name, labels, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[(name, labels)] = [[0] * (len(self.buckets) + 1), 0.0]
+            histogram[0][index] += 1
+            histogram[1] += seconds
+
+    def inc(self, name, labels, amount=1):
+        with self.lock:
+            self.counters[(name, labels)] = self.counters.get((name, labels), 0) + amount
+
+    def add(self, name, labels, amount):
+        with self.lock:
+            self.gauges[(name, labels)] = self.gauges.get((name, labels), 0) + amount
+
+    def set(self, name, labels, value):
+        with self.lock:
+            self.gauges[(name, labels)] = value
+
+    def render(self):
+        with self.lock:
+            histograms = {key: (list(counts), total) for key, (counts, total) in self.histograms.items()}
+            series = {**self.counters, **self.gauges}
+
+        lines = []
+        for name, (kind, description) in self.descriptions.items():
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+            if kind == 'histogram':
+                for (metric, labels), (counts, total) in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip((*self.buckets, '+Inf'), counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{formatlabels(labels + (('le', bound),))} {cumulative}")
+                    lines.append(f"{name}_sum{formatlabels(labels)} {total}")
+                    lines.append(f"{name}_count{formatlabels(labels)} {cumulative}")
+            else:
+                lines += [f"{name}{formatlabels(labels)} {value}"
+                          for (metric, labels), value in sorted(series.items()) if metric == name]
+        return '\n'.join(lines) + '\n'
+
+
+def formatlabels(labels):
+    return '{' + ','.join(f'{label}="{value}"' for label, value in labels) + '}' if labels else ''
+
+
+metrics = Metrics()
+metrics.set('travel_startup_seconds', (('phase', 'imports'),), importSeconds)
+
+
+class OperationTimer:
+    """Context manager recording the time taken by one operation
+
+    The duration is added to the operation's histogram and, inside a request,
+    to the request's total for the operation, which is reported in the
+    `Server-Timing` response header.
+    """
+
+    __slots__ = ('operation', 'labels', 'start')
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.labels = (('operation', operation),)
+
+    def __enter__(self):
+        metrics.add('travel_operations_in_flight', self.labels, 1)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, exc, traceback):
+        metrics.add('travel_operations_in_flight', self.labels, -1)
+        recordoperation(self.operation, time.perf_counter() - self.start, failed=excType is not None)
+        return False
+
+
+def recordoperation(operation, elapsed, failed=False):
+    labels = (('operation', operation),)
+    metrics.observe('travel_operation_duration_seconds', labels, elapsed)
+    if failed:
+        metrics.inc('travel_operation_errors_total', labels)
+    if has_request_context():
+        timings = g.setdefault('timings', {})
+        timings[operation] = timings.get(operation, 0) + elapsed
+
+
+def timed(operation):
+    """Times a block as a 'query', 'search', 'kv', 'jwt' or 'json' operation"""
+    return OperationTimer(operation)
+
+
+# Response bodies can be encoded by a faster library than the standard one.
+# Its output must be byte for byte what Flask's encoder would produce, so it
+# is only used for compact bodies, any object it cannot encode is handed to
+# the standard encoder, and non-ASCII characters are escaped as they are by
+# `ensure_ascii`. With the development server's debug mode, Flask indents
+# the JSON, so the standard encoder is always used.
+
+nonAscii = re.compile('[\x7f-\U0010ffff]')
+
+
+def escapeascii(match):
+    code = ord(match.group())
+    if code > 0xffff:
+        code -= 0x10000
+        return '\\u{0:04x}\\u{1:04x}'.format(0xd800 | (code >> 10), 0xdc00 | (code & 0x3ff))
+    return '\\u{0:04x}'.format(code)
+
+
+# orjson writes floats as the standard library does, except for those below
+# 1e-4, e.g. 0.00001 and 1e-7 rather than 1e-05 and 1e-07, and NaN and the
+# infinities, which it writes as null. Output that could hold one of these is
+# encoded again by the standard library, so the bytes are always the same.
+
+floatExponent = re.compile(b'e-[0-9]')
+
+
+def orjsonencoder():
+    """Returns a function encoding an object as the given JSONEncoder would with orjson, or None if it cannot"""
+    try:
+        import orjson
+    except ImportError:
+        parser.error("--json-encoder orjson needs the orjson package: pip install orjson")
+
+    # Dates and dataclasses are passed to the encoder's default(), which
+    # formats them as Flask does.
+
+    options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+
+    def encode(o, encoder):
+        body = orjson.dumps(o, default=encoder.default,
+                            option=options | orjson.OPT_SORT_KEYS if encoder.sort_keys else options)
+        if b'null' in body or b'0.0000' in body or floatExponent.search(body):
+            return None
+        text = body.decode('utf-8')
+        if encoder.ensure_ascii and (not text.isascii() or '\x7f' in text):
+            text = nonAscii.sub(escapeascii, text)
+        return text
+
+    return encode
+
+
+jsonEncoders = {
+    'stdlib': lambda: None,
+    'orjson': orjsonencoder,
+}
+
+fastencode = None
+
+
+class FastJSONEncoder(JSONEncoder):
+    """Flask's JSON encoder, using the `--json-encoder` backend for compact JSON"""
+
+    def encode(self, o):
+        if fastencode is not None and self.indent is None and \
+                self.item_separator == ',' and self.key_separator == ':':
+            try:
+                text = fastencode(o, self)
+            except TypeError:
+                text = None
+            if text is not None:
+                return text
+        return super().encode(o)
+
+
+class TimedJSONEncoder(FastJSONEncoder):
+    """Flask's JSON encoder, timing every response body it encodes"""
+
+    def encode(self, o):
+        with timed('json'):
+            return super().encode(o)
+
+
+app.json_encoder = TimedJSONEncoder
+
+
+def streamresponse(rows, context, operation, collect=None, page=None):
+    """Returns a response encoding {"data": rows, "context": context} as rows are read
+
+    Only one row is held at a time, however many the result has. The context
+    is encoded after the last row, so it can still be added to while the rows
+    are read. The time spent reading rows is recorded as `operation`, if any,
+    but is not in the `Server-Timing` header, as the headers are sent first.
+    Any `page` fields, such as the cursor of the next page, are encoded last.
+    Once the body has been sent in full, it is passed to `collect`, if given.
+    """
+    encoder = FastJSONEncoder(separators=(',', ':'), sort_keys=app.config['JSON_SORT_KEYS'],
+                              ensure_ascii=app.config['JSON_AS_ASCII'])
+
+    def generate():
+        readTime = encodeTime = 0
+        yield '{"data":['
+        rowIterator = iter(rows)
+        separator = ''
+        while True:
+            start = time.perf_counter()
+            try:
+                row = next(rowIterator)
+            except StopIteration:
+                break
+            except Exception as e:
+                # The status has already been sent, so the error can only be
+                # logged and the truncated body left for the client to reject.
+                if operation:
+                    recordoperation(operation, time.perf_counter() - start + readTime, failed=True)
+                print(f"Failed while streaming {request.path}: {e}", flush=True)
+                raise
+            read = time.perf_counter()
+            encoded = encoder.encode(row)
+            readTime += read - start
+            encodeTime += time.perf_counter() - read
+            yield separator + encoded
+            separator = ','
+        start = time.perf_counter()
+        trailer = ''.join(f',"{key}":{encoder.encode(value)}' for key, value in (page or {}).items())
+        yield '],"context":' + encoder.encode(context) + trailer + '}\n'
+        if operation:
+            recordoperation(operation, readTime)
+        recordoperation('json', encodeTime + time.perf_counter() - start)
+
+    def tee(chunks):
+        body = []
+        for chunk in chunks:
+            body.append(chunk)
+            yield chunk
+        collect(''.join(body).encode('utf-8'))
+
+    body = generate() if collect is None else tee(generate())
+    return app.response_class(stream_with_context(body), mimetype='application/json')
+
+
+# Large /api bodies are compressed with the best encoding the client accepts.
+# Each encoding is a class with the interface of brotli's Compressor, so a
+# streamed body can be compressed as it is sent.
+
+class GzipCompressor:
+
+    def __init__(self, level):
+        self.compressor = zlib.compressobj(min(level, 9), zlib.DEFLATED, 31)
+
+    def process(self, data):
+        return self.compressor.compress(data)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+class ZstdCompressor:
+
+    def __init__(self, level):
+        import zstandard
+        self.compressor = zstandard.ZstdCompressor(level=min(level, 22)).compressobj()
+
+    def process(self, data):
+        return self.compressor.compress(data)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+def brotlicompressor(level):
+    import brotli
+    return brotli.Compressor(quality=min(level, 11))
+
+
+compressors = {
+    'gzip': (None, GzipCompressor),
+    'br': ('brotli', brotlicompressor),
+    'zstd': ('zstandard', ZstdCompressor),
+}
+
+encodings = []
+
+
+def availableencodings(names):
+    """Returns the named encodings, in order, leaving out those whose package is missing
+
+    Missing packages are only reported for encodings asked for explicitly.
+    """
+    available = []
+    for name in filter(None, names.split(',')):
+        if name not in compressors:
+            parser.error(f"--compression encodings must be among {', '.join(compressors)}")
+        package = compressors[name][0]
+        if package is not None and importlib.util.find_spec(package) is None:
+            if names != parser.get_default('compression'):
+                print(f"Not compressing with {name}, as the {package} package is not installed", flush=True)
+            continue
+        available.append(name)
+    return available
+
+
+def negotiateencoding():
+    """Returns the preferred encoding among those the request accepts with the highest quality, if any"""
+    best, bestQuality = None, 0
+    for name in encodings:
+        quality = request.accept_encodings.quality(name)
+        if quality > bestQuality:
+            best, bestQuality = name, quality
+    return best
+
+
+@api.after_request
+def compress(response):
+    if not encodings or 'Content-Encoding' in response.headers or request.method == 'HEAD' or \
+            response.status_code in (204, 304) or response.mimetype != 'application/json':
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiateencoding()
+    if encoding is None:
+        return response
+
+    # A streamed body is read until it reaches the minimum size, so that a
+    # small one is still sent as is, and is then compressed as it is sent.
+
+    if response.is_streamed:
+        chunks = response.iter_encoded()
+        head = []
+        size = 0
+        for chunk in chunks:
+            head.append(chunk)
+            size += len(chunk)
+            if size >= args.compression_min_size:
+                break
+        else:
+            response.set_data(b''.join(head))
+            return response
+        response.response = compressstream(compressors[encoding][1](args.compression_level), head, chunks)
+    else:
+        body = response.get_data()
+        if len(body) < args.compression_min_size:
+            return response
+        with timed('compress'):
+            compressor = compressors[encoding][1](args.compression_level)
+            response.set_data(compressor.process(body) + compressor.finish())
+    response.headers['Content-Encoding'] = encoding
+
+    # A compressed body is a different representation, so it gets its own
+    # ETag, which is weak if that of the uncompressed body is.
+
+    etag, weak = response.get_etag()
+    if etag is not None:
+        response.set_etag(f"{etag}-{encoding}", weak)
+    return response
+
+
+def compressstream(compressor, head, chunks):
+    """Yields the compressed body of a streamed response, whose first chunks have been read"""
+    start = time.perf_counter()
+    compressed = compressor.process(b''.join(head))
+    compressTime = time.perf_counter() - start
+    if compressed:
+        yield compressed
+    for chunk in chunks:
+        start = time.perf_counter()
+        compressed = compressor.process(chunk)
+        compressTime += time.perf_counter() - start
+        if compressed:
+            yield compressed
+    start = time.perf_counter()
+    compressed = compressor.finish()
+    recordoperation('compress', compressTime + time.perf_counter() - start)
+    yield compressed
+
+
+# Airport and hotel responses carry an ETag made from the version of the
+# inventory and the normalized query, and a repeated request with a matching
+# 'If-None-Match' is answered with a 304 before Couchbase is read. Only the
+# airport prefix index has a real version, a digest of its contents, which
+# makes its ETags strong. The query and search services have none, and may
+# return rows in a different order, so their results get weak ETags that
+# change with the current window of '--cache-max-age' seconds, plus the
+# generation of a shared hotel cache, so that every process computes the
+# same ETag.
+
+def inventoryversion(dataset):
+    """Returns a version of the inventory behind a dataset, and whether it is weak, as it only expires over time"""
+    if dataset == 'airports' and args.airport_search == 'index' and airportIndex.loaded:
+        return airportIndex.version, False
+    version = f"w{int(time.time() // args.cache_max_age)}"
+    if dataset == 'hotels' and isinstance(hotelCache, CouchbaseCache):
+        version += f"g{hotelCache.currentGeneration()}"
+    return version, True
+
+
+def notmodified(dataset, query):
+    """Returns a 304 response if the client already has the response to the query, otherwise None
+
+    The ETag of the response, and whether it is weak, are kept in `g.etag`, to be added by `tagresponse`.
+    """
+    if not args.cache_max_age:
+        return None
+    try:
+        version, weak = inventoryversion(dataset)
+    except (CouchbaseException, DeadlineExceeded):
+        return None
+    etag = hashlib.sha1(repr((dataset, version, args.responses, query)).encode('utf-8')).hexdigest()
+    g.etag = (etag, weak)
+
+    # 'If-None-Match' is compared weakly, so a tag matches whether or not
+    # either side marks it as weak.
+
+    for etag in (etag, *(f"{etag}-{encoding}" for encoding in encodings)):
+        if request.if_none_match.contains_weak(etag):
+            response = make_response('', 304)
+            response.set_etag(etag, weak)
+            if encodings:
+                response.vary.add('Accept-Encoding')
+            response.cache_control.public = True
+            response.cache_control.max_age = args.cache_max_age
+            return response
+    return None
+
+
+@api.after_request
+def tagresponse(response):
+    etag = g.pop('etag', None)
+    if etag is not None and response.status_code == 200:
+        response.set_etag(*etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = args.cache_max_age
+    return response
+
+
+# Requests are labelled with their URL rule rather than their path, so that
+# e.g. every '/api/airports?search=...' shares one series.
+
+firstResponse = threading.Event()
+
+
+@app.before_request
+def start_timing():
+    g.requestStart = time.perf_counter()
+    g.routeLabels = (('route', request.url_rule.rule if request.url_rule else 'unmatched'),
+                     ('method', request.method))
+    metrics.add('travel_http_requests_in_flight', g.routeLabels, 1)
+
+
+@app.after_request
+def report_timing(response):
+    if 'requestStart' not in g:
+        return response
+    elapsed = time.perf_counter() - g.requestStart
+    timings = g.get('timings', {})
+    response.headers['Server-Timing'] = ', '.join(
+        [f"{operation};dur={duration * 1000:.2f}" for operation, duration in timings.items()] +
+        [f"total;dur={elapsed * 1000:.2f}"])
+
+    metrics.observe('travel_http_request_duration_seconds', g.routeLabels, elapsed)
+    metrics.inc('travel_http_requests_total', g.routeLabels + (('status', response.status_code),))
+    if response.status_code >= 500:
+        metrics.inc('travel_http_request_errors_total', g.routeLabels)
+
+    # Time-to-first-request is what a restarted container or a newly scaled
+    # out worker keeps its callers waiting, so it is logged as well as kept.
+    # A forked worker inherits the import of its parent, so its figure
+    # includes the time it waited to be forked. Health checks don't count.
+    if not firstResponse.is_set() and request.endpoint not in healthChecks:
+        firstResponse.set()
+        startup = time.perf_counter() - importStarted
+        metrics.set('travel_startup_seconds', (('phase', 'first_response'),), startup)
+        print(f"First response after {startup:.3f}s (imports {importSeconds:.3f}s)")
+    return response
+
+
+@app.teardown_request
+def stop_timing(exc):
+    if 'routeLabels' in g:
+        metrics.add('travel_http_requests_in_flight', g.routeLabels, -1)
+
+
+@app.route('/metrics')
+def metricsendpoint():
+    """Returns request and operation metrics in the Prometheus text format
+    ---
+    responses:
+        200:
+          description: Returns the metrics of the worker process that handled the request
+          content:
+            text/plain:
+              example: travel_http_requests_total{route="/api/airports",method="GET",status="200"} 12
+    """
+    response = make_response(metrics.render())
+    response.mimetype = 'text/plain'
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
+
+class AdmissionLimit:
+    """Bounds the requests in flight for one route or tenant
+
+    Requests over the limit wait in a queue of `queue` places until their
+    deadline, and are turned away at once when the queue is full, so an
+    overload is shed quickly instead of building up a backlog.
+    """
+
+    def __init__(self, limit, queue):
+        self.limit = limit
+        self.queue = queue
+        self.inflight = 0
+        self.waiting = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, timeout):
+        with self.condition:
+            if self.inflight < self.limit:
+                self.inflight += 1
+                return True
+            if self.waiting >= self.queue:
+                return False
+            self.waiting += 1
+            try:
+                admitted = self.condition.wait_for(lambda: self.inflight < self.limit, timeout)
+                if admitted:
+                    self.inflight += 1
+                return admitted
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self.condition:
+            self.inflight -= 1
+            self.condition.notify()
+
+
+# The number of threads of each worker process is only known when `serve`
+# runs the production server. The development server handles one request at
+# a time, and another WSGI server has its own thread count.
+
+serverThreads = None
+
+
+class AdmissionControl:
+    """Admission limits per `/api` route and per tenant
+
+    A waiting request holds a worker thread as much as a running one does.
+    A tenant at its limit is therefore turned away at once, so that it never
+    holds more than `--tenant-concurrency` threads, and a route's requests,
+    running and waiting, leave at least one thread of the production server
+    for the other routes.
+    The tenant's limit is taken before its route's, so a tenant that is
+    turned away doesn't hold a place that other tenants could use. Only
+    tenants that are scopes of the bucket get a limit; requests for any
+    other tenant are answered with a 404 by the view.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+        self.tenants = {}
+
+    def limit(self, limits, key, size, queue):
+        with self.lock:
+            limit = limits.get(key)
+            if limit is None:
+                limit = limits[key] = AdmissionLimit(size, queue)
+            return limit
+
+    def admit(self, route, tenant, deadline):
+        """Returns the limits taken for the request, or None and the kind of limit that refused it"""
+        wanted = []
+        if tenant is not None and args.tenant_concurrency and collectionHandles.knowntenant(tenant):
+            wanted.append(('tenant', self.limit(self.tenants, tenant, args.tenant_concurrency, 0)))
+        if args.route_concurrency:
+            queue = args.admission_queue
+            if serverThreads is not None:
+                queue = min(queue, serverThreads - 1 - args.route_concurrency)
+            wanted.append(('route', self.limit(self.routes, route, args.route_concurrency, queue)))
+        taken = []
+        for kind, limit in wanted:
+            if not limit.acquire(max(0.0, deadline - time.monotonic())):
+                self.release(taken)
+                return None, kind
+            taken.append(limit)
+        return taken, None
+
+    def release(self, taken):
+        for limit in reversed(taken):
+            limit.release()
+
+
+admissionControl = AdmissionControl()
+
+
+# Every /api request has a deadline, set per view here, and each query,
+# search and KV call is given what is left of it as its timeout. Once it has
+# passed no further calls are made: views that gather results from several
+# calls return what they have, marked as partial, and the others fail with a
+# 504 rather than leave the client waiting on a stalled node. The timeout
+# exceptions of the SDK are answered the same way.
+
+routeDeadlines = {
+    'airports': 5.0,
+    'flightPaths': 5.0,
+    'hotels': 5.0,
+    'nearbyairports': 2.5,
+    'nearbyhotels': 2.5,
+    'login': 2.5,
+    'signup': 2.5,
+    'getflights': 5.0,
+    'updateflights': 5.0,
+}
+
+deadlines = dict(routeDeadlines)
+
+timeoutErrors = (AmbiguousTimeoutException, UnAmbiguousTimeoutException)
+
+
+class DeadlineExceeded(Exception):
+    """Raised instead of making a call once the request's deadline has passed"""
+
+
+def remaining():
+    """Returns the time left before the request's deadline, or None without one"""
+    deadline = g.get('deadline') if has_request_context() else None
+    if deadline is None:
+        return None
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise DeadlineExceeded()
+    return timedelta(seconds=left)
+
+
+def deadlineoptions(timeout=None):
+    """Returns the `timeout` option of a call, shortened to fit in the request's deadline"""
+    left = remaining()
+    if left is not None and (timeout is None or left < timeout):
+        timeout = left
+    return {} if timeout is None else {'timeout': timeout}
+
+
+@api.before_request
+def startdeadline():
+    seconds = deadlines.get(request.endpoint.rpartition('.')[2])
+    g.deadline = time.monotonic() + seconds if seconds else None
+
+
+@api.errorhandler(DeadlineExceeded)
+def deadlineexceeded(e):
+    return abortmsg(504, "Request deadline exceeded")
+
+
+@api.errorhandler(AmbiguousTimeoutException)
+@api.errorhandler(UnAmbiguousTimeoutException)
+def timedout(e):
+    print(f"Request timed out - has Couchbase stopped running? {e}", flush=True)
+    return abortmsg(504, "Request timed out")
+
+
+# A tenant over its limit is told to slow down with a 429, while a route over
+# its limit means the process itself is overloaded, which is a 503. Either
+# way the client is told when to try again.
+
+@api.before_request
+def admit():
+    if request.method == 'OPTIONS' or not (args.route_concurrency or args.tenant_concurrency):
+        return None
+    started = time.perf_counter()
+    tenant = (request.view_args or {}).get('tenant')
+    deadline = time.monotonic() + args.admission_wait
+    if g.deadline is not None:
+        deadline = min(deadline, g.deadline)
+    taken, refusedBy = admissionControl.admit(request.url_rule.rule, lowercase(tenant) if tenant else None, deadline)
+    recordoperation('queue', time.perf_counter() - started)
+    if taken is None:
+        metrics.inc('travel_admission_rejections_total', g.routeLabels + (('limit', refusedBy),))
+        response = abortmsg(429 if refusedBy == 'tenant' else 503, f"Too many requests for this {refusedBy}, "
+                                                                  "try again later")
+        response.headers['Retry-After'] = str(max(1, math.ceil(args.admission_wait)))
+        return response
+    g.admitted = taken
+
+
+@api.teardown_request
+def release(exc):
+    admissionControl.release(g.pop('admitted', []))
+
+
+# Every SQL++ statement runs with the options of its endpoint, set here in one
+# place. Airports and routes are reference data that rarely changes, so no
+# query waits for the indexes to catch up with recent writes.
+
+queryProfiles = {
+    'airport-index': {'scan_consistency': QueryScanConsistency.NOT_BOUNDED, 'timeout': timedelta(seconds=120)},
+    'route-index': {'scan_consistency': QueryScanConsistency.NOT_BOUNDED, 'timeout': timedelta(seconds=120)},
+    'airport-geo-index': {'scan_consistency': QueryScanConsistency.NOT_BOUNDED, 'timeout': timedelta(seconds=120)},
+    'hotel-geo-index': {'scan_consistency': QueryScanConsistency.NOT_BOUNDED, 'timeout': timedelta(seconds=120)},
+    'airports': {'scan_consistency': QueryScanConsistency.NOT_BOUNDED, 'timeout': timedelta(seconds=5)},
+    'nearby-airports': {'scan_consistency': QueryScanConsistency.NOT_BOUNDED, 'timeout': timedelta(seconds=5)},
+    'faa': {'scan_consistency': QueryScanConsistency.NOT_BOUNDED, 'timeout': timedelta(seconds=5)},
+    'routes': {'scan_consistency': QueryScanConsistency.NOT_BOUNDED, 'timeout': timedelta(seconds=10)},
+}
+
+preparedStatements = set()
+preparedLock = threading.Lock()
+
+
+def runquery(cluster, profile, statement, *params, **namedParams):
+    """Runs a SQL++ statement with the options in queryProfiles[profile]
+
+    With `--query-mode prepared` the statement is sent with adhoc=False, so
+    the query service plans it once and the SDK reuses the prepared plan
+    afterwards. Statement text must therefore not vary between requests:
+    values go in parameters. The statements this process has prepared are
+    tracked to count plan cache hits and misses.
+    """
+    profileOptions = queryProfiles[profile]
+    options = QueryOptions(adhoc=args.query_mode == 'adhoc',
+                           **{**profileOptions, **deadlineoptions(profileOptions.get('timeout'))})
+    if args.query_mode == 'prepared':
+        with preparedLock:
+            hit = statement in preparedStatements
+            preparedStatements.add(statement)
+        metrics.inc('travel_query_plans_total', (('statement', profile), ('result', 'hit' if hit else 'miss')))
+    return cluster.query(statement, options, *params, **namedParams)
+
+
+caches = {}
+
+
+class LRUCache:
+    """Bounded least-recently-used cache with optional expiry
+
+    The cache holds at most `maxsize` entries and, when `maxbytes` is set, at
+    most that many bytes of (bytes or str) values. Every cache is registered
+    by name in `caches` so that its hit and miss counters can be reported,
+    and its entries purged, through `/api/caches`.
+    """
+
+    def __init__(self, name, maxsize, ttl=0, maxbytes=0):
+        self.name = name
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        caches[name] = self
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if not expires or expires > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self.remove(key)
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl else 0
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (value, expires)
+            if self.maxbytes:
+                self.bytes += len(value)
+            while len(self.entries) > self.maxsize or (self.maxbytes and self.bytes > self.maxbytes):
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        value, _ = self.entries.pop(key)
+        if self.maxbytes:
+            self.bytes -= len(value)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        stats = {'size': len(self.entries), 'maxsize': self.maxsize, 'ttl': self.ttl,
+                 'hits': self.hits, 'misses': self.misses}
+        if self.maxbytes:
+            stats.update({'bytes': self.bytes, 'maxbytes': self.maxbytes})
+        return stats
+
+
+class CouchbaseCache:
+    """Cache shared by every process, held as documents with an expiry
+
+    Entries are stored as raw JSON in a collection of their own, kept apart
+    from the sample data, under keys that include a generation number. Purging bumps the number,
+    so old entries are no longer read and simply expire. Each process reads
+    the generation at most once every `generationTTL` seconds.
+    """
+
+    generationTTL = 5
+
+    def __init__(self, name, ttl, scope, collection):
+        self.name = name
+        self.ttl = ttl
+        self.scope = scope
+        self.collectionName = collection
+        self.prefix = f"cache::{name}::"
+        self.generation = None
+        self.generationAt = 0
+        self.hits = 0
+        self.misses = 0
+        caches[name] = self
+
+    def collection(self):
+        return collectionHandles.collection(self.scope, self.collectionName)
+
+    def currentGeneration(self):
+        if self.generation is None or time.monotonic() - self.generationAt > self.generationTTL:
+            try:
+                with timed('kv'):
+                    self.generation = self.collection().get(self.prefix + 'generation').content_as[int]
+            except DocumentNotFoundException:
+                self.generation = 0
+            self.generationAt = time.monotonic()
+        return self.generation
+
+    def key(self, key):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return f"{self.prefix}{self.currentGeneration()}::{digest}"
+
+    def get(self, key, default=None):
+        try:
+            key = self.key(key)
+            with timed('kv'):
+                value = self.collection().get(key, GetOptions(transcoder=RawJSONTranscoder(),
+                                                              **deadlineoptions())).value
+            self.hits += 1
+            return value
+        except (CouchbaseException, DeadlineExceeded):
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        try:
+            key = self.key(key)
+            with timed('kv'):
+                self.collection().upsert(key, value,
+                                         UpsertOptions(transcoder=RawJSONTranscoder(), expiry=timedelta(seconds=ttl),
+                                                       **deadlineoptions()))
+        except (CouchbaseException, DeadlineExceeded) as e:
+            print(f"Failed to cache {self.name} entry: {e}", flush=True)
+
+    def clear(self):
+        with timed('kv'):
+            self.collection().binary().increment(self.prefix + 'generation', IncrementOptions(initial=SignedInt64(1)))
+        self.generation = None
+
+    def stats(self):
+        return {'ttl': self.ttl, 'hits': self.hits, 'misses': self.misses, 'shared': True}
+
+
+faaCache = LRUCache('faa', 1024, 3600)
+
+
+class CollectionHandles:
+    """Collection handles keyed by (scope, collection), reused across requests
+
+    Handles are opened on first use and kept in a bounded LRU cache, which is
+    emptied whenever the process connects. Tenant names are checked before
+    use: a name that is not a valid scope name is rejected outright, and the
+    scopes of the bucket are listed so that a request for a tenant that does
+    not exist fails at once instead of timing out. The list is re-read when
+    an unknown name turns up, at most every `scopesTTL` seconds, so new
+    tenants are picked up. Requests for unknown names wait for the listing,
+    which is given at most `scopesTimeout`. If the scopes cannot be listed,
+    names are not checked against them.
+    """
+
+    scopesTTL = 30
+    scopesTimeout = timedelta(seconds=2)
+    scopeName = re.compile(r'^[A-Za-z0-9-][A-Za-z0-9_%-]{0,250}$')
+
+    def __init__(self, maxsize):
+        self.handles = LRUCache('collections', maxsize)
+        self.scopes = None
+        self.scopesAt = 0
+        self.lock = threading.Lock()
+
+    def reset(self):
+        self.handles.clear()
+        with self.lock:
+            self.scopes = None
+            self.scopesAt = 0
+
+    def collection(self, scope, name):
+        handle = self.handles.get((scope, name))
+        if handle is None:
+            handle = bucket.scope(scope).collection(name)
+            self.handles.set((scope, name), handle)
+        return handle
+
+    def knowntenant(self, tenant):
+        """Returns True unless tenant is not the name of a scope in the bucket"""
+        if not self.scopeName.match(tenant):
+            return False
+        if self.scopes is not None and tenant in self.scopes:
+            return True
+        with self.lock:
+            if time.monotonic() - self.scopesAt > self.scopesTTL:
+                options = GetAllScopesOptions(**deadlineoptions(self.scopesTimeout))
+                self.scopesAt = time.monotonic()
+                try:
+                    with timed('kv'):
+                        self.scopes = {scope.name for scope in bucket.collections().get_all_scopes(options)}
+                except CouchbaseException as e:
+                    print(f"Failed to list scopes, tenant names are not checked: {e}", flush=True)
+                    self.scopes = None
+            return self.scopes is None or tenant in self.scopes
+
+    def preload(self, tenants):
+        """Opens the users and bookings handles of each tenant, and the hotel handle"""
+        self.collection('inventory', 'hotel')
+        for tenant in tenants:
+            for name in ('users', 'bookings'):
+                self.collection(tenant, name)
+
+
+collectionHandles = CollectionHandles(256)
+
+
+class CacheView:
+    """Class for inspecting the in-process caches"""
+
+    @api.route('/caches', methods=['GET', 'OPTIONS'])
+    @cross_origin(supports_credentials=True)
+    def cachestats():
+        """Returns the size and hit/miss counters of every cache
+        ---
+        tags:
+        - caches
+        responses:
+            200:
+              description: Returns cache statistics keyed by cache name
+              content:
+                application/json:
+                  schema:
+                    $ref: '#/components/schemas/ResultSingleton'
+                  example:
+                    context: ["In-process cache statistics"]
+                    data: {"faa": {"size": 2, "maxsize": 1024, "ttl": 3600, "hits": 10, "misses": 2}}
+        """
+        return jsonify({'data': {name: cache.stats() for name, cache in caches.items()},
+                        'context': ["In-process cache statistics"]})
+
+    @api.route('/caches/<name>', methods=['DELETE', 'OPTIONS'])
+    @cross_origin(supports_credentials=True)
+    def purgecache(name):
+        """Purges every entry from a cache
+        ---
+        tags:
+        - caches
+        parameters:
+            - name: name
+              in: path
+              required: true
+              schema:
+                type: string
+              example: hotels
+              description: Cache name, as listed by `/api/caches`
+        responses:
+            200:
+              description: Returns the statistics of the purged cache
+              content:
+                application/json:
+                  schema:
+                    $ref: '#/components/schemas/ResultSingleton'
+                  example:
+                    context: ["Purged cache hotels"]
+                    data: {"size": 0, "maxsize": 1000, "ttl": 300, "hits": 10, "misses": 2}
+            401:
+              description: Returns an error for a missing or invalid operator token
+              content:
+                application/json:
+                    schema:
+                      $ref: '#/components/schemas/Error'
+            403:
+              description: Returns an error when no operator token is configured
+              content:
+                application/json:
+                    schema:
+                      $ref: '#/components/schemas/Error'
+            404:
+              description: Returns an error for an unknown cache
+              content:
+                application/json:
+                    schema:
+                      $ref: '#/components/schemas/Error'
+        security:
+            - operator: []
+        """
+        error = operatorerror(request.headers.get('Authorization'))
+        if error is not None:
+            return abortmsg(*error)
+        if name not in caches:
+            return abortmsg(404, "Unknown cache: " + name)
+        caches[name].clear()
+        return jsonify({'data': caches[name].stats(), 'context': [f"Purged cache {name}"]})
+
+
+class AirportIndex:
+    """In-memory prefix index over the name, FAA and ICAO code of every airport
+
+    Airports are kept in a sorted list of (lowercase name, name, key) tuples
+    so that a name prefix can be located with a binary search, while FAA and
+    ICAO codes are exact matches held in dicts. The tuples double as keyset
+    cursors, as every airport has a distinct one. The index is loaded once
+    from `inventory.airport`.
+    """
+
+    statement = "SELECT airportname, faa, icao, META().id AS id FROM `travel-sample`.inventory.airport"
+    profile = 'airport-index'
+
+    def __init__(self):
+        self.keys = []
+        self.codes = {'faa': {}, 'icao': {}}
+        self.version = None
+        self.loaded = False
+
+    def load(self, cluster):
+        with timed('query'):
+            self.build(runquery(cluster, self.profile, self.statement))
+
+    def build(self, results):
+        keys = []
+        codes = {'faa': {}, 'icao': {}}
+        for airport in results:
+            name = airport.get('airportname')
+            if not name:
+                continue
+            key = (name.lower(), name, airport.get('id') or '')
+            keys.append(key)
+            for field in codes:
+                if airport.get(field):
+                    codes[field].setdefault(airport[field].upper(), []).append(key)
+
+        keys.sort()
+        for matches in (*codes['faa'].values(), *codes['icao'].values()):
+            matches.sort()
+        self.version = hashlib.sha1(repr((keys, sorted(codes['faa'].items()), sorted(codes['icao'].items())))
+                                    .encode('utf-8')).hexdigest()[:16]
+        self.keys = keys
+        self.codes = codes
+        self.loaded = True
+        print(f"Loaded {len(self.keys)} airports into the prefix index", flush=True)
+
+    def search(self, field, term, limit=0):
+        """Returns [{'airportname': ...}] rows matching the search term"""
+        return [{'airportname': name} for _, name, _ in self.match(field, term, limit)]
+
+    def match(self, field, term, limit=0, after=None):
+        """Returns the keys of the airports matching the search term, in order
+
+        With `after`, only the keys sorting after that key are returned.
+        """
+        if field in self.codes:
+            keys = self.codes[field].get(term.upper(), [])
+            start, end = 0, len(keys)
+        else:
+            # Every name starting with the prefix sorts between the prefix
+            # itself and the prefix followed by the highest code point.
+            keys = self.keys
+            prefix = term.lower()
+            start = bisect.bisect_left(keys, (prefix,))
+            end = bisect.bisect_left(keys, (prefix + '\U0010ffff',), lo=start)
+        if after is not None:
+            start = bisect.bisect_right(keys, tuple(after), lo=start, hi=end)
+        if limit:
+            end = min(end, start + limit)
+        return keys[start:end]
+
+
+airportIndex = AirportIndex()
+
+
+class AirportView:
     """Airport class for airport objects in the database"""
 
     @api.route('/airports', methods=['GET', 'OPTIONS'])
@@ -170,6 +1486,19 @@ class AirportView(SwaggerView):
                 type: string
               example: SFO
               description: The airport name/code to search for
+            - name: limit
+              in: query
+              required: false
+              schema:
+                type: integer
+              example: 20
+              description: Maximum number of airports to return, in airport name order
+            - name: cursor
+              in: query
+              required: false
+              schema:
+                type: string
+              description: Return the airports after the previous page, taken from its `next` field
         responses:
             200:
               description: Returns airport data and query context information
@@ -195,27 +1524,193 @@ class AirportView(SwaggerView):
         # queries for a substring match at the start of the 'airportname' field
 
         if sameCase and len(partialAirportName) == 3:
-            queryPrep += "faa=$1"
-            queryArgs = [partialAirportName.upper()]
+            searchField = 'faa'
         elif sameCase and len(partialAirportName) == 4:
-            queryPrep += "icao=$1"
-            queryArgs = [partialAirportName.upper()]
+            searchField = 'icao'
         else:
+            searchField = 'airportname'
+
+        # With a 'limit', airports are returned a page at a time, ordered by
+        # their lowercase name, name and key. The opaque 'cursor' holds these
+        # values for the last airport of the previous page, so the next page
+        # starts right after it rather than skipping over the earlier pages.
+
+        limit = parselimit(request.args.get('limit'))
+        if limit is None:
+            return abortmsg(400, "limit must be a positive integer")
+        after = None
+        if 'cursor' in request.args:
+            after = decodecursor(request.args['cursor'], 3)
+            if after is None:
+                return abortmsg(400, "Invalid cursor")
+        page = {}
+
+        response = notmodified('airports', (partialAirportName, limit, request.args.get('cursor')))
+        if response is not None:
+            return response
+
+        # When the prefix index has been loaded at startup, the lookup is
+        # answered in-process without a round trip to the query service.
+
+        if args.airport_search == 'index' and airportIndex.loaded:
+            context = [f"Prefix index lookup - in-memory copy of inventory.airport: {searchField} matching "
+                       f"'{partialAirportName}'"]
+            pageLimit = min(limit, args.airport_limit or limit)
+            keys = airportIndex.match(searchField, partialAirportName,
+                                      pageLimit + 1 if pageLimit else args.airport_limit, after)
+            rows = ({'airportname': name} for _, name, _ in paginate(keys, pageLimit, list, page))
+            if args.responses == 'streamed':
+                return streamresponse(rows, context, None, page=page)
+            airports = list(rows)
+            return make_response(jsonify({"data": airports, "context": context, **page}))
+
+        if limit or after is not None:
+            queryPrep = "SELECT airportname, [LOWER(airportname), airportname, META().id] AS cursor \
+                        FROM `travel-sample`.inventory.airport WHERE "
+
+        if searchField == 'airportname':
             queryPrep += "POSITION(LOWER(airportname), $1) = 0"
             queryArgs = [partialAirportName.lower()]
+        else:
+            queryPrep += f"{searchField}=$1"
+            queryArgs = [partialAirportName.upper()]
 
-        results = cluster.query(queryPrep, *queryArgs)
-        airports = [x for x in results]
+        if limit or after is not None:
+            if after is not None:
+                queryPrep += " AND [LOWER(airportname), airportname, META().id] > $2"
+                queryArgs.append(after)
+            queryPrep += " ORDER BY LOWER(airportname), airportname, META().id"
+            if limit:
+                queryArgs.append(limit + 1)
+                queryPrep += f" LIMIT ${len(queryArgs)}"
 
         # 'context' is returned to the frontend to be shown in the Query Log
 
         context = [queryType + queryPrep]
 
-        response = make_response(jsonify({"data": airports, "context": context}))
+        # When streaming, the rows are encoded as the SDK returns them instead
+        # of being collected into a list first.
+
+        if args.responses == 'streamed':
+            results = runquery(cluster, 'airports', queryPrep, *queryArgs)
+            if limit or after is not None:
+                results = ({'airportname': row['airportname']}
+                           for row in paginate(results, limit, lambda row: row['cursor'], page))
+            return streamresponse(results, context, 'query', page=page)
+
+        with timed('query'):
+            results = runquery(cluster, 'airports', queryPrep, *queryArgs)
+            airports = [x for x in results]
+
+        if limit or after is not None:
+            airports = [{'airportname': row['airportname']}
+                        for row in paginate(airports, limit, lambda row: row['cursor'], page)]
+
+        response = make_response(jsonify({"data": airports, "context": context, **page}))
         return response
 
 
-class FlightPathsView(SwaggerView):
+class RouteIndex:
+    """Flight schedules keyed by (sourceairport, destinationairport, day)
+
+    Every route schedule is unnested and joined with its airline once, and
+    each key holds its flights already ordered by airline name, so a search
+    only copies out the matching rows. The index is rebuilt on refresh, or
+    when it is older than `--route-ttl` seconds. After a failed background
+    rebuild, the next one waits at least `retryDelay` seconds.
+    """
+
+    fields = ('name', 'flight', 'utc', 'sourceairport', 'destinationairport', 'equipment')
+    statement = "SELECT a.name, s.flight, s.utc, s.day, r.sourceairport, r.destinationairport, r.equipment \
+                FROM `travel-sample`.inventory.route AS r \
+                UNNEST r.schedule AS s \
+                JOIN `travel-sample`.inventory.airline AS a ON KEYS r.airlineid"
+    profile = 'route-index'
+    retryDelay = 60
+
+    def __init__(self):
+        self.schedules = {}
+        self.flights = 0
+        self.loaded = False
+        self.loadedAt = 0
+        self.retryAt = 0
+        self.lock = threading.Lock()
+        self.rebuilding = False
+
+    def load(self, cluster):
+        with timed('query'):
+            self.build(runquery(cluster, self.profile, self.statement))
+
+    def build(self, results):
+        # Schedule times and flight numbers repeat across thousands of routes
+        # and days, so they are shared rather than stored once per row.
+        shared = {}
+        schedules = {}
+        flights = 0
+        for row in results:
+            key = (row.get('sourceairport'), row.get('destinationairport'), row.get('day'))
+            flight = tuple(shared.setdefault(row.get(field), row.get(field)) for field in self.fields)
+            schedules.setdefault(key, []).append(flight)
+            flights += 1
+
+        for flightList in schedules.values():
+            flightList.sort(key=lambda flight: flight[0] or '')
+
+        with self.lock:
+            self.schedules = schedules
+            self.flights = flights
+            self.loaded = True
+            self.loadedAt = time.monotonic()
+        print(f"Loaded {flights} flights on {len(schedules)} routes into the route index", flush=True)
+
+    def stale(self):
+        """Returns True once for an expired index, claiming its rebuild"""
+        if not args.route_ttl or time.monotonic() - self.loadedAt < args.route_ttl or time.monotonic() < self.retryAt:
+            return False
+        return self.claim()
+
+    def claim(self):
+        """Returns True if no rebuild is under way, claiming the next one"""
+        with self.lock:
+            if self.rebuilding:
+                return False
+            self.rebuilding = True
+            return True
+
+    def failed(self, e):
+        """Logs a failed background rebuild, and puts off the next one"""
+        self.retryAt = time.monotonic() + self.retryDelay
+        print(f"Route index rebuild failed: {e}", flush=True)
+
+    def refresh_if_stale(self, cluster):
+        """Rebuilds the index in the background once it has expired"""
+        if not self.stale():
+            return
+
+        def rebuild():
+            try:
+                self.load(cluster)
+            except CouchbaseException as e:
+                self.failed(e)
+            finally:
+                self.rebuilding = False
+
+        threading.Thread(target=rebuild, daemon=True).start()
+
+    def search(self, sourceairport, destinationairport, day):
+        """Returns one new dict per scheduled flight, ordered by airline name"""
+        return list(self.iterate(sourceairport, destinationairport, day))
+
+    def iterate(self, sourceairport, destinationairport, day):
+        """Yields the dicts returned by `search` one at a time"""
+        flights = self.schedules.get((sourceairport, destinationairport, day), [])
+        return (dict(zip(self.fields, flight)) for flight in flights)
+
+
+routeIndex = RouteIndex()
+
+
+class FlightPathsView:
     """ FlightPath class for computed flights between two airports FAA codes"""
 
     @api.route('/flightPaths/<fromLoc>/<toLoc>', methods=['GET', 'OPTIONS'])
@@ -257,8 +1752,8 @@ class FlightPathsView(SwaggerView):
                   schema:
                     $ref: '#/components/schemas/ResultList'
                   example:
-                    context: ["SQL++ query - scoped to inventory: SELECT faa as fromAirport FROM `travel-sample`.inventory.airport
-                    WHERE airportname = $1 UNION SELECT faa as toAirport FROM `travel-sample`.inventory.airport WHERE airportname = $2"]
+                    context: ["SQL++ query - scoped to inventory: SELECT airportname, faa FROM `travel-sample`.inventory.airport
+                    WHERE airportname IN $1"]
                     data: [{
                               "destinationairport": "LAX",
                               "equipment": "738",
@@ -276,31 +1771,33 @@ class FlightPathsView(SwaggerView):
         queryType = "SQL++ query - scoped to inventory: "
         context = []
 
-        faaQueryPrep = "SELECT faa as fromAirport FROM `travel-sample`.inventory.airport \
-                        WHERE airportname = $1 \
-                        UNION SELECT faa as toAirport FROM `travel-sample`.inventory.airport \
-                        WHERE airportname = $2"
-        
-        faaResults = cluster.query(faaQueryPrep, fromLoc, toLoc)
-
-        # The query results are an iterable object consisting of dicts with the
-        # fields from each doc. The results from the query will be formatted as
-        # [{'fromAirport':<faa code>}, {'toAirport':<faa code>}]
-        # Note, results are unordered, so the ordering above may be inaccurate.
-        # The iterable therefore needs to be flattened so the correct field can
-        # be extracted.
-        
-        flightPathDict = {}
-        for result in faaResults:
-            flightPathDict.update(result)
+        # Airport names are resolved to FAA codes through a cache. Any names
+        # that are not cached are resolved together in a single query, and the
+        # rows carry the airport name so each code is matched to its name. An
+        # airport without a code is cached as '', so it gets its 404 from the
+        # cache rather than from a query on every request.
+
+        faaCodes = {name: faaCache.get(name) for name in (fromLoc, toLoc)}
+        missingNames = sorted({name for name, faa in faaCodes.items() if faa is None})
 
-        # flightPathDict will be formatted as
-        # {'fromAirport':<faa code>, 'toAirport':<faa code>}
+        if missingNames:
+            faaQueryPrep = "SELECT airportname, faa FROM `travel-sample`.inventory.airport \
+                            WHERE airportname IN $1"
+            with timed('query'):
+                faaResults = list(runquery(cluster, 'faa', faaQueryPrep, missingNames))
 
-        queryFrom = flightPathDict['fromAirport']
-        queryTo = flightPathDict['toAirport']
+            for result in faaResults:
+                faaCodes[result['airportname']] = result['faa'] or ''
+                faaCache.set(result['airportname'], result['faa'] or '')
 
-        context.append(queryType + faaQueryPrep)
+            context.append(queryType + faaQueryPrep)
+        else:
+            context.append(f"FAA cache hit - airport names resolved in-process: {fromLoc}, {toLoc}")
+
+        queryFrom = faaCodes.get(fromLoc)
+        queryTo = faaCodes.get(toLoc)
+        if not queryFrom or not queryTo:
+            return abortmsg(404, "Unknown airport: " + (toLoc if queryFrom else fromLoc))
 
         routeQueryPrep = "SELECT a.name, s.flight, s.utc, r.sourceairport, r.destinationairport, r.equipment \
                         FROM `travel-sample`.inventory.route AS r \
@@ -314,10 +1811,33 @@ class FlightPathsView(SwaggerView):
         # the format in the database.
 
         flightDay = convdate(request.args['leave'])
-        routeResults = cluster.query(routeQueryPrep, 
-                                     fromfaa=queryFrom, 
-                                     tofaa=queryTo, 
-                                     dayofweek=flightDay)
+
+        # When the route index has been built, the schedule is read from memory
+        # with the airline name already joined and the rows already sorted.
+
+        if args.route_search == 'index' and routeIndex.loaded:
+            routeIndex.refresh_if_stale(cluster)
+            context.append(f"Route index lookup - precomputed from inventory.route and inventory.airline: "
+                           f"sourceairport={queryFrom}, destinationairport={queryTo}, day={flightDay}")
+            if args.responses == 'streamed':
+                return streamresponse(priced(routeIndex.iterate(queryFrom, queryTo, flightDay)), context, None)
+
+            routesList = routeIndex.search(queryFrom, queryTo, flightDay)
+            for route in routesList:
+                route['price'] = math.ceil(random() * 500) + 250
+            return make_response(jsonify({"data": routesList, "context": context}))
+
+        if args.responses == 'streamed':
+            context.append(queryType + routeQueryPrep)
+            routeResults = runquery(cluster, 'routes', routeQueryPrep,
+                                    fromfaa=queryFrom, tofaa=queryTo, dayofweek=flightDay)
+            return streamresponse(priced(routeResults), context, 'query')
+
+        with timed('query'):
+            routeResults = list(runquery(cluster, 'routes', routeQueryPrep,
+                                         fromfaa=queryFrom,
+                                         tofaa=queryTo,
+                                         dayofweek=flightDay))
 
         # The 'QueryResult' object can only be iterated over once - any further
         # attempts to do so will result in an 'AlreadyQueried' exception. It is
@@ -337,8 +1857,62 @@ class FlightPathsView(SwaggerView):
         response = make_response(jsonify({"data": routesList, "context": context}))
         return response
 
+    @api.route('/flightPaths/refresh', methods=['POST', 'OPTIONS'])
+    @cross_origin(supports_credentials=True)
+    def refreshFlightPaths():
+        """Rebuild the route index from the route and airline collections
+        ---
+        tags:
+        - flightPaths
+        responses:
+            200:
+              description: Returns the size of the rebuilt index
+              content:
+                application/json:
+                  schema:
+                    $ref: '#/components/schemas/ResultSingleton'
+                  example:
+                    context: ["Route index rebuilt from inventory.route and inventory.airline"]
+                    data: {"routes": 17629, "flights": 486012}
+            401:
+              description: Returns an error for a missing or invalid operator token
+              content:
+                application/json:
+                    schema:
+                      $ref: '#/components/schemas/Error'
+            403:
+              description: Returns an error when no operator token is configured
+              content:
+                application/json:
+                    schema:
+                      $ref: '#/components/schemas/Error'
+            409:
+              description: Returns an error while the index is already being rebuilt
+              content:
+                application/json:
+                    schema:
+                      $ref: '#/components/schemas/Error'
+        security:
+            - operator: []
+        """
+        error = operatorerror(request.headers.get('Authorization'))
+        if error is not None:
+            return abortmsg(*error)
 
-class TenantUserView(SwaggerView):
+        # A refresh shares the single rebuild of '--route-ttl', so that
+        # concurrent calls do not each scan every route.
+
+        if not routeIndex.claim():
+            return abortmsg(409, "The route index is already being rebuilt")
+        try:
+            routeIndex.load(cluster)
+        finally:
+            routeIndex.rebuilding = False
+        return jsonify({'data': {'routes': len(routeIndex.schedules), 'flights': routeIndex.flights},
+                        'context': ["Route index rebuilt from inventory.route and inventory.airline"]})
+
+
+class TenantUserView:
     """Class for storing user related information for a given tenant"""
 
     @api.route('/tenants/<tenant>/user/login', methods=['POST', 'OPTIONS'])
@@ -397,25 +1971,33 @@ class TenantUserView(SwaggerView):
         userDocumentKey = lowercase(user)
 
         agent = lowercase(tenant)
-        scope = bucket.scope(agent)
-        users = scope.collection('users')
+        if not collectionHandles.knowntenant(agent):
+            return abortmsg(404, "Unknown tenant: " + tenant)
+        users = collectionHandles.collection(agent, 'users')
 
-        queryType = f"KV get - scoped to {scope.name}.users: for password field in document "
+        queryType = f"KV get - scoped to {agent}.users: for password field in document "
 
         # Perform a sub-document GET request for the 'password' field on a
         # document with the provided username as the key.
         try:
-            documentPassword = users.lookup_in(userDocumentKey, (
-                SD.get('password'),
-            )).content_as[str](0)
+            options = deadlineoptions()
+            with timed('kv'):
+                documentPassword = hedged(
+                    'login',
+                    lambda: users.lookup_in(userDocumentKey, (
+                        SD.get('password'),
+                    ), LookupInOptions(**options)).content_as[str](0),
+                    lambda: users.get_any_replica(
+                        userDocumentKey, GetAnyReplicaOptions(**options)).content_as[dict]['password'])
 
             if documentPassword != providedPassword:
                 return abortmsg(401, "Password does not match")
 
         except DocumentNotFoundException:
             print(f"User {user} item does not exist", flush=True)
-        except AmbiguousTimeoutException or UnAmbiguousTimeoutException:
-            print("Request timed out - has Couchbase stopped running?", flush=True)
+        except timeoutErrors as e:
+            print(f"Request timed out - has Couchbase stopped running? {e}", flush=True)
+            return abortmsg(504, "Request timed out")
         else:
             return jsonify({'data': {'token': genToken(user)}, 'context': [queryType + user]})
 
@@ -477,13 +2059,16 @@ class TenantUserView(SwaggerView):
         userDocumentKey = lowercase(user)
 
         agent = lowercase(tenant)
-        scope = bucket.scope(agent)
-        users = scope.collection('users')
+        if not collectionHandles.knowntenant(agent):
+            return abortmsg(404, "Unknown tenant: " + tenant)
+        users = collectionHandles.collection(agent, 'users')
 
-        queryType = f"KV insert - scoped to {scope.name}.users: document "
+        queryType = f"KV insert - scoped to {agent}.users: document "
 
         try:
-            users.insert(userDocumentKey, {'username': user, 'password': password})
+            with timed('kv'):
+                users.insert(userDocumentKey, {'username': user, 'password': password},
+                             InsertOptions(**deadlineoptions()))
             responseJSON = jsonify(
                 {'data': {'token': genToken(user)}, 'context': [queryType + user]})
             response = make_response(responseJSON)
@@ -492,9 +2077,12 @@ class TenantUserView(SwaggerView):
         except DocumentExistsException:
             print(f"User {user} item already exists", flush=True)
             return abortmsg(409, "User already exists")
+        except (DeadlineExceeded, *timeoutErrors):
+            # Answered with a 504 by the blueprint's error handlers
+            raise
         except Exception as e:
-            print(e)
-            return abortmsg(500, "Failed to save user", flush=True)
+            print(e, flush=True)
+            return abortmsg(500, "Failed to save user")
 
     @api.route('/tenants/<tenant>/user/<username>/flights', methods=['GET', 'OPTIONS'])
     @cross_origin(supports_credentials=True)
@@ -518,6 +2106,19 @@ class TenantUserView(SwaggerView):
                 type: string
               example: user1
               description: Username
+            - name: limit
+              in: query
+              required: false
+              schema:
+                type: integer
+              example: 20
+              description: Maximum number of bookings to return
+            - name: since
+              in: query
+              required: false
+              schema:
+                type: string
+              description: Return the bookings made after this booking, taken from the `next` field of a previous page
         responses:
             200:
               description: Returns flight data and query context information
@@ -551,6 +2152,12 @@ class TenantUserView(SwaggerView):
                                 "utc": "20:47:00"
                               }
                             ]
+            400:
+              description: Returns an error for an invalid limit, or a since that is not one of the user's bookings
+              content:
+                application/json:
+                    schema:
+                      $ref: '#/components/schemas/Error'
             401:
               description: Returns an authentication error
               content:
@@ -561,41 +2168,107 @@ class TenantUserView(SwaggerView):
             - bearer: []
         """
         agent = lowercase(tenant)
+        if not collectionHandles.knowntenant(agent):
+            return abortmsg(404, "Unknown tenant: " + tenant)
 
-        scope = bucket.scope(agent)
-        users = scope.collection('users')
-        flights = scope.collection('bookings')
+        users = collectionHandles.collection(agent, 'users')
+        flights = collectionHandles.collection(agent, 'bookings')
 
         # HTTP token authentication
-        bearer = request.headers['Authorization']
-        if not auth(bearer, username):
+        tokenUser = tokenuser(request.headers.get('Authorization'))
+        if tokenUser is None:
+            return abortmsg(401, 'Missing or invalid bearer token')
+        if tokenUser != username:
             return abortmsg(401, 'Username does not match token username: ' + username)
+
+        limit = parselimit(request.args.get('limit'))
+        if limit is None:
+            return abortmsg(400, "limit must be a positive integer")
         
         try:
             userDocumentKey = lowercase(username)
             
             # The lookup does both a 'get' and an 'exists' in the same op. This
-            # avoids having to handle a 'PathNotFoundException'.
-
-            lookupResult = users.lookup_in(
-              userDocumentKey,
-              [
-                SD.get('bookings'),
-                SD.exists('bookings')
-              ])
-            
-            bookedFlightKeys = []
-            if lookupResult.exists(1):
-                bookedFlightKeys = lookupResult.content_as[list](0)
-
-            # GET requests are now performed to get the content of the bookings
+            # avoids having to handle a 'PathNotFoundException'. When hedged,
+            # the replica read gets the whole user document.
+
+            options = deadlineoptions()
+
+            def activebookings():
+                lookupResult = users.lookup_in(
+                  userDocumentKey,
+                  [
+                    SD.get('bookings'),
+                    SD.exists('bookings')
+                  ],
+                  LookupInOptions(**options))
+                return lookupResult.content_as[list](0) if lookupResult.exists(1) else []
+
+            def replicabookings():
+                return users.get_any_replica(userDocumentKey, GetAnyReplicaOptions(**options)) \
+                    .content_as[dict].get('bookings', [])
+
+            with timed('kv'):
+                bookedFlightKeys = hedged('user-bookings', activebookings, replicabookings)
+
+            # Booking keys are appended in the order the flights were booked, so
+            # a long history is paged by the key the previous page ended on. A
+            # key that is not among them is rejected, rather than starting over
+            # from the first page, which would page forever.
+
+            since = request.args.get('since')
+            if since is not None:
+                if since not in bookedFlightKeys:
+                    return abortmsg(400, "Unknown booking in since: " + since)
+                bookedFlightKeys = bookedFlightKeys[bookedFlightKeys.index(since) + 1:]
+            nextKey = None
+            if limit and len(bookedFlightKeys) > limit:
+                bookedFlightKeys = bookedFlightKeys[:limit]
+                nextKey = bookedFlightKeys[-1]
+
+            # The bookings are fetched with one batched multi-get, which sends
+            # every GET concurrently. A booking that cannot be read, e.g. as it
+            # was not returned before the deadline, is reported in the context
+            # and the response is marked as partial instead of failing.
+
+            bookingResults = None
+            if bookedFlightKeys:
+                options = deadlineoptions()
+
+                def replicaresults():
+                    # Only a replica answer with every booking beats the active node
+                    replicaResults = flights.get_any_replica_multi(bookedFlightKeys,
+                                                                   GetAnyReplicaMultiOptions(**options))
+                    if not replicaResults.all_ok:
+                        raise next(iter(replicaResults.exceptions.values()))
+                    return replicaResults
+
+                with timed('kv'):
+                    bookingResults = hedged(
+                        'bookings',
+                        lambda: flights.get_multi(bookedFlightKeys, GetMultiOptions(**options)),
+                        replicaresults)
 
             rows = []
+            failedKeys = []
             for key in bookedFlightKeys:
-                rows.append(flights.get(key).content_as[dict])
-
-            queryType = f"KV get - scoped to {scope.name}.users: for {len(bookedFlightKeys)} bookings in document "
-            response = make_response(jsonify({"data": rows, "context": [queryType + userDocumentKey]}))
+                if key in bookingResults.results:
+                    rows.append(bookingResults.results[key].content_as[dict])
+                else:
+                    print(f"Failed to get booking {key}: {bookingResults.exceptions.get(key)}", flush=True)
+                    failedKeys.append(key)
+
+            queryType = f"KV get - scoped to {agent}.users: for {len(bookedFlightKeys)} bookings in document "
+            context = [queryType + userDocumentKey]
+            if failedKeys:
+                context.append(f"KV get failed - scoped to {agent}.bookings: for documents {', '.join(failedKeys)}")
+
+            responseJSON = {"data": rows, "context": context}
+            if failedKeys:
+                responseJSON['partial'] = True
+            if nextKey:
+                responseJSON['next'] = nextKey
+            response = make_response(jsonify(responseJSON))
             return response
         
         except DocumentNotFoundException:
@@ -604,7 +2277,7 @@ class TenantUserView(SwaggerView):
     @api.route('/tenants/<tenant>/user/<username>/flights', methods=['PUT', 'OPTIONS'])
     @cross_origin(supports_credentials=True)
     def updateflights(tenant, username):
-        """Book a new flight for a user
+        """Book one or more new flights for a user
         ---
         tags:
         - tenants
@@ -642,13 +2315,15 @@ class TenantUserView(SwaggerView):
                                }]
         responses:
             200:
-              description: Returns flight data and query context information
+              description: Returns the booked flights, any flights that could not be booked, and query context
+                information
               content:
                 application/json:
                   schema:
                     $ref: '#/components/schemas/ResultSingleton'
                   example:
-                    context: ["KV update - scoped to tenant_agent_00.users: for bookings field in document user1"]
+                    context: ["KV upsert - scoped to tenant_agent_00.bookings: 1 documents in one batch",
+                              "KV update - scoped to tenant_agent_00.users: for bookings field in document user1"]
                     data:
                       added: [{
                                "date": "12/12/2020",
@@ -658,6 +2333,12 @@ class TenantUserView(SwaggerView):
                                "price": 50.0,
                                "sourceairport": "London (Gatwick)"
                              }]
+            400:
+              description: Returns an error when no flights are given
+              content:
+                application/json:
+                    schema:
+                      $ref: '#/components/schemas/Error'
             401:
               description: Returns an authentication error
               content:
@@ -669,46 +2350,90 @@ class TenantUserView(SwaggerView):
         """
         agent = lowercase(tenant)
         user = lowercase(username)
+        if not collectionHandles.knowntenant(agent):
+            return abortmsg(404, "Unknown tenant: " + tenant)
 
-        scope = bucket.scope(agent)
-        users = scope.collection('users')
-        bookings = scope.collection('bookings')
+        users = collectionHandles.collection(agent, 'users')
+        bookings = collectionHandles.collection(agent, 'bookings')
 
-        queryType = f"KV update - scoped to {scope.name}.users: for bookings field in document "
+        queryType = f"KV update - scoped to {agent}.users: for bookings field in document "
 
         # HTTP token authentication
-        bearer = request.headers['Authorization']
-        if not auth(bearer, username):
+        tokenUser = tokenuser(request.headers.get('Authorization'))
+        if tokenUser is None:
+            return abortmsg(401, 'Missing or invalid bearer token')
+        if tokenUser != username:
             return abortmsg(401, 'Username does not match token username: ' + username)
         
-        # Add the flight details to a new document in the bookings collection.
+        flights = (request.get_json(silent=True) or {}).get('flights')
+        if not isinstance(flights, list) or not flights:
+            return abortmsg(400, "No flights to book")
+
+        # Each flight's details go in a new document in the bookings
+        # collection. The documents are written in one batched multi-upsert,
+        # which sends every write concurrently; a flight that cannot be
+        # written is reported back instead of failing the others.
+
+        bookingKeys = {str(uuid.uuid4()): flight for flight in flights if isinstance(flight, dict)}
+        failed = [{'flight': flight, 'error': "Flight details must be an object"}
+                  for flight in flights if not isinstance(flight, dict)]
+
+        written = []
+        if bookingKeys:
+            with timed('kv'):
+                upsertResults = bookings.upsert_multi(bookingKeys, UpsertMultiOptions(**deadlineoptions()))
+            for key, flight in bookingKeys.items():
+                if key in upsertResults.exceptions:
+                    print(f"Failed to add booking {key}: {upsertResults.exceptions[key]}", flush=True)
+                    failed.append({'flight': flight, 'error': "Failed to add flight data"})
+                else:
+                    written.append(key)
+
+        if not written:
+            return abortmsg(500, "Failed to add flight data")
+
+        # The bookings are documents not associated with a user. A single
+        # Sub-Document op appends all of their keys to the 'bookings' field in
+        # the given user's document. If that definitely fails, the booking
+        # documents are removed again rather than left behind unreferenced.
+        # After an ambiguous failure the append may still have been applied,
+        # so the user's bookings are read back to tell.
 
         try:
-            flightData = request.get_json()['flights'][0]
-            flightID = str(uuid.uuid4())
-            bookings.upsert(flightID, flightData)
+            mutateOptions = MutateInOptions(**deadlineoptions())
+        except DeadlineExceeded:
+            removebookings(bookings, written)
+            return abortmsg(504, "Request timed out, no flights were booked")
 
+        try:
+            with timed('kv'):
+                users.mutate_in(user, (SD.array_append('bookings', *written, create_parents=True),), mutateOptions)
+        except (AmbiguousTimeoutException, RequestCanceledException) as e:
+            print(f"Ambiguous bookings update for {user}: {e}", flush=True)
+            applied = bookingsapplied(users, user, written)
+            if applied is None:
+                return abortmsg(504, "Request timed out, it is unknown whether the flights were booked")
+            if not applied:
+                removebookings(bookings, written)
+                return abortmsg(504, "Request timed out, no flights were booked")
         except Exception as e:
+            removebookings(bookings, written)
+            if isinstance(e, DocumentNotFoundException):
+                return abortmsg(401, "User does not exist")
+            if isinstance(e, UnAmbiguousTimeoutException):
+                return abortmsg(504, "Request timed out, no flights were booked")
             print(e, flush=True)
-            return abortmsg(500, "Failed to add flight data")
-        
-        # The booking is document not associated with a user. A Sub-Document op
-        # is performed to add the key of the booking document to the 'bookings'
-        # field in the given user's document.
-        
-        try:
-            users.mutate_in(user, (SD.array_append('bookings', flightID, create_parents=True),))
-            resultJSON = {'data': {'added': [flightData]},
-                          'context': [queryType + user]}
-            return make_response(jsonify(resultJSON))
-        
-        except DocumentNotFoundException:
-            return abortmsg(401, "User does not exist")
-        except Exception:
             return abortmsg(500, "Couldn't update flights")
 
+        resultJSON = {'data': {'added': [bookingKeys[key] for key in written]},
+                      'context': [f"KV upsert - scoped to {agent}.bookings: {len(written)} documents in one batch",
+                                  queryType + user]}
+        if failed:
+            resultJSON['data']['failed'] = failed
+        return make_response(jsonify(resultJSON))
 
-class HotelView(SwaggerView):
+
+class HotelView:
     """Class for storing Hotel search related information"""
 
     @api.route('/hotels/<description>/<location>/', methods=['GET'])
@@ -735,6 +2460,20 @@ class HotelView(SwaggerView):
                 type: string
               example: San Francisco
               description: Hotel location 
+            - name: limit
+              in: query
+              required: false
+              schema:
+                type: integer
+                maximum: 100
+              example: 20
+              description: Maximum number of hotels to return, 100 by default
+            - name: cursor
+              in: query
+              required: false
+              schema:
+                type: string
+              description: Return the hotels after the previous page, taken from its `next` field
         responses:
             200:
               description: Returns hotel data and query context information
@@ -758,6 +2497,40 @@ class HotelView(SwaggerView):
                             }
                          ]
         """ 
+        # Hits are returned a page at a time, ordered by score and then key.
+        # The opaque 'cursor' holds the sort values of the last hit of the
+        # previous page, and the search continues after it ('search_after'),
+        # so the index never collects and discards the earlier pages.
+
+        limit = parselimit(request.args.get('limit'))
+        if limit is None:
+            return abortmsg(400, "limit must be a positive integer")
+        limit = min(limit or 100, 100)
+        after = None
+        if 'cursor' in request.args:
+            after = decodecursor(request.args['cursor'], 2)
+            if after is None:
+                return abortmsg(400, "Invalid cursor")
+        page = {}
+
+        # Repeated searches are answered from the response cache. Search terms
+        # are matched case-insensitively, so the key is normalized to match.
+
+        cacheKey = tuple(' '.join(term.lower().split()) or '*' for term in (description, location)) + \
+            (limit, request.args.get('cursor'))
+        response = notmodified('hotels', cacheKey)
+        if response is not None:
+            return response
+        if hotelCache is not None:
+            cachedResponse = hotelCache.get(cacheKey)
+            if cachedResponse is not None:
+                response = make_response(cachedResponse)
+                response.mimetype = 'application/json'
+                response.headers['X-Cache'] = 'HIT'
+                return response
+
+        import couchbase.search as FT
+
         queryPrep = FT.ConjunctionQuery()
         if location != '*' and location != "":
             queryPrep.conjuncts.append(
@@ -783,56 +2556,657 @@ class HotelView(SwaggerView):
             response = {'data': [], 'context': [queryType]}
             return jsonify(response)
             
-        searchRows = cluster.search_query('hotels-index', 
-                                          queryPrep, 
-                                          SearchOptions(limit=100))
+        hotelFields = [*hotelAddressFields, *hotelDataFields]
+
+        # With '--hotel-search stored' the fields are stored in the FTS index
+        # (see 'fts-hotels-index.json') and returned with each hit, so no
+        # further requests are needed.
+
+        # One hit more than the page is requested, to tell if there is a next.
+
+        hotelSort = ['-_score', '_id']
+        if args.hotel_search == 'stored':
+            searchOptions = SearchOptions(limit=limit + 1, sort=hotelSort, fields=hotelFields, **deadlineoptions())
+        else:
+            searchOptions = SearchOptions(limit=limit + 1, sort=hotelSort, **deadlineoptions())
+        if after is not None:
+            searchOptions['raw'] = {'search_after': after}
+
+        hotel_collection = collectionHandles.collection('inventory', 'hotel')
+        queryType = f"FTS search - scoped to: inventory.hotel within fields {','.join(hotelFields)}"
+
+        # When streaming, each hit is encoded as the search returns it, and
+        # the response is only cached once it has been sent in full. As it
+        # may yet turn out to be partial, it is sent without an ETag.
+
+        if args.responses == 'streamed':
+            context = [queryType]
+            searchRows = paginate(cluster.search_query('hotels-index', queryPrep, searchOptions), limit,
+                                  lambda hotel: list(hotel.sort), page)
+            rows = (hotelrow(fields) for fields in streamhotels(searchRows, hotel_collection, hotelFields, context,
+                                                                  page))
+            cacheBody = None
+            if hotelCache is not None:
+                cacheBody = lambda body: None if page.get('partial') else hotelCache.set(cacheKey, body)
+            g.pop('etag', None)
+            response = streamresponse(rows, context, None, cacheBody, page)
+            if hotelCache is not None:
+                response.headers['X-Cache'] = 'MISS'
+            return response
 
-        # The 'SearchResult' object returned by the search does not contain the
-        # full document, consisting of just matches and metadata. This metadata
-        # includes the document key, so sub-document operations retrieve all of
-        # the fields needed by the frontend.
+        hits = []
+        storedFields = {}
+        with timed('search'):
+            searchRows = cluster.search_query('hotels-index', queryPrep, searchOptions)
+            for hotel in paginate(searchRows, limit, lambda hotel: list(hotel.sort), page):
+                hits.append(hotel.id)
+                if hotel.fields:
+                    storedFields[hotel.id] = dict(hotel.fields)
+
+        # Otherwise the 'SearchResult' object returned by the search does not
+        # contain the full document, consisting of just matches and metadata.
+        # This metadata includes the document key, so sub-document operations
+        # retrieve all of the fields needed by the frontend. The lookups are
+        # issued concurrently rather than one after another.
+
+        missingHits = [hotelId for hotelId in hits if hotelId not in storedFields]
+        lookupFields = {}
+        if missingHits:
+            with timed('kv'):
+                lookupFields = lookuphotels(hotel_collection, missingHits, hotelFields)
 
         allResults = []
-        addressFields = ['address', 'city', 'state', 'country']
-        dataFields = ['name', 'description']
+        for hotelId in hits:
+            fields = storedFields.get(hotelId) or lookupFields.get(hotelId)
+            if fields is None:
+                continue
+            allResults.append(hotelrow(fields))
+
+        # Hotels that could not be looked up in time are left out, and the
+        # response is marked as partial, and not cached.
+
+        context = [queryType]
+        if missingHits:
+            context.append(f"KV sub-document get - scoped to inventory.hotel: for {len(missingHits)} documents, "
+                           f"{args.hotel_lookup_workers} at a time")
+        if len(lookupFields) < len(missingHits):
+            page['partial'] = True
+        response = jsonify({'data': allResults, 'context': context, **page})
+        if page.get('partial'):
+            g.pop('etag', None)
+            return response
+        if hotelCache is not None:
+            hotelCache.set(cacheKey, response.get_data())
+            response.headers['X-Cache'] = 'MISS'
+        return response
 
-        scope = bucket.scope('inventory')
-        hotel_collection = scope.collection('hotel')
 
-        for hotel in searchRows:
-            
-            # The lookup will succeed even if the document does not contain all
-            # fields. Attempting to read these none existent fields will result
-            # in a 'DocumentNotFoundException'.
+earthRadius = 6371.0088  # mean radius in km
 
-            hotelFields = hotel_collection.lookup_in(
-                hotel.id, [SD.get(x) for x in [*addressFields, *dataFields]])
 
-            # Concatenates the first 4 fields to form the address. 
+def unitvector(lat, lon):
+    """Returns the point on the unit sphere at a latitude and longitude in degrees"""
+    lat, lon = math.radians(lat), math.radians(lon)
+    return (math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat))
 
-            hotelAddress = []
-            for x in range(len(addressFields)):
-                try:
-                    hotelAddress.append(hotelFields.content_as[str](x))
-                except:
-                    pass
-            hotelAddress = ', '.join(hotelAddress)
 
-            # Extracts the other fields.
+def chorddistance(squaredChord):
+    """Returns the great-circle distance in km between points a (squared) chord apart on the unit sphere"""
+    return 2 * earthRadius * math.asin(min(1.0, math.sqrt(squaredChord) / 2))
+
 
-            hotelData = {}
-            for x, field in enumerate(dataFields):
-                try:    
-                    hotelData[field] = hotelFields.content_as[str](x+len(addressFields))
-                except:
-                    pass
-                
-            hotelData['address'] = hotelAddress
-            allResults.append(hotelData)
+def geodistance(lat, lon, geo):
+    """Returns the great-circle distance in km from a location to a `geo` field"""
+    a, b = unitvector(lat, lon), unitvector(geo['lat'], geo['lon'])
+    return chorddistance(sum((x - y) ** 2 for x, y in zip(a, b)))
 
-        queryType = f"FTS search - scoped to: {scope.name}.hotel within fields {','.join([*addressFields, *dataFields])}"
-        response = {'data': allResults, 'context': [queryType]}
-        return jsonify(response)
+
+hotelAddressFields = ['address', 'city', 'state', 'country']
+hotelDataFields = ['name', 'description']
+
+
+def hotelrow(fields):
+    """Returns the name, description and address of a hotel, as shown by the frontend"""
+    # Concatenates the first 4 fields to form the address, then extracts the
+    # other fields.
+
+    hotelData = {field: fields[field] for field in hotelDataFields if field in fields}
+    hotelData['address'] = ', '.join(fields[field] for field in hotelAddressFields if field in fields)
+    return hotelData
+
+
+class GeoIndex:
+    """In-memory k-d tree over the locations of the documents in a collection
+
+    Locations are held as points on the unit sphere, whose straight-line
+    distances order them as their great-circle distances do, with no special
+    cases at the poles or the antimeridian. The tree is implicit: the median
+    of each slice of `points`, along the axis of its depth, splits the rest
+    of the slice in two. The index is loaded once from `statement`, whose
+    rows hold a `geo` field and are turned into response rows by `row`.
+    """
+
+    def __init__(self, name, profile, statement, row):
+        self.name = name
+        self.profile = profile
+        self.statement = statement
+        self.row = row
+        self.points = []
+        self.loaded = False
+
+    def load(self, cluster):
+        with timed('query'):
+            self.build(runquery(cluster, self.profile, self.statement))
+
+    def build(self, results):
+        points = []
+        for document in results:
+            geo = document.get('geo') or {}
+            if not isinstance(geo.get('lat'), (int, float)) or not isinstance(geo.get('lon'), (int, float)):
+                continue
+            points.append((unitvector(geo['lat'], geo['lon']), self.row(document)))
+        self.arrange(points, 0, len(points), 0)
+        self.points = points
+        self.loaded = True
+        print(f"Loaded {len(points)} {self.name} into the geo index", flush=True)
+
+    def arrange(self, points, start, end, axis):
+        if end - start < 2:
+            return
+        points[start:end] = sorted(points[start:end], key=lambda point: point[0][axis])
+        middle = (start + end) // 2
+        self.arrange(points, start, middle, (axis + 1) % 3)
+        self.arrange(points, middle + 1, end, (axis + 1) % 3)
+
+    def nearest(self, lat, lon, k, radius=0):
+        """Returns up to k (distance in km, row) pairs nearest to a location, within `radius` km if set
+
+        The slices are searched depth first, nearer side first, and a slice is
+        skipped when its splitting plane is further away than the k-th nearest
+        point found so far.
+        """
+        target = unitvector(lat, lon)
+        bound = (2 * math.sin(min(radius / earthRadius, math.pi) / 2)) ** 2 if radius else math.inf
+        nearest = []  # max-heap of (-squared distance, position)
+        slices = [(0, len(self.points), 0, 0.0)]
+        while slices:
+            start, end, axis, planeDistance = slices.pop()
+            furthest = -nearest[0][0] if len(nearest) == k else bound
+            if start >= end or planeDistance > furthest:
+                continue
+            middle = (start + end) // 2
+            point = self.points[middle][0]
+            distance = (target[0] - point[0]) ** 2 + (target[1] - point[1]) ** 2 + (target[2] - point[2]) ** 2
+            if distance <= furthest:
+                if len(nearest) == k:
+                    heapq.heapreplace(nearest, (-distance, middle))
+                else:
+                    heapq.heappush(nearest, (-distance, middle))
+            offset = target[axis] - point[axis]
+            lower, upper = (start, middle), (middle + 1, end)
+            near, far = (lower, upper) if offset < 0 else (upper, lower)
+            slices.append((*far, (axis + 1) % 3, offset * offset))
+            slices.append((*near, (axis + 1) % 3, 0.0))
+        return [(chorddistance(-distance), self.points[position][1])
+                for distance, position in sorted(nearest, reverse=True)]
+
+
+airportGeoIndex = GeoIndex(
+    'airports', 'airport-geo-index', "SELECT airportname, faa, icao, city, country, geo FROM `travel-sample`.inventory.airport "
+                "WHERE geo IS VALUED",
+    lambda airport: {field: airport.get(field) for field in ('airportname', 'faa', 'icao', 'city', 'country')})
+hotelGeoIndex = GeoIndex(
+    'hotels', 'hotel-geo-index', "SELECT name, description, address, city, state, country, geo FROM `travel-sample`.inventory.hotel "
+              "WHERE geo IS VALUED", hotelrow)
+
+
+class NearbyView:
+    """Location based lookups of airports and hotels"""
+
+    @api.route('/airports/nearby', methods=['GET', 'OPTIONS'])
+    @cross_origin(supports_credentials=True)
+    def nearbyairports():
+        """Returns the airports nearest to a location
+        ---
+        tags:
+        - airports
+        parameters:
+            - name: lat
+              in: query
+              required: true
+              schema:
+                type: number
+              example: 37.62
+              description: Latitude in degrees
+            - name: lon
+              in: query
+              required: true
+              schema:
+                type: number
+              example: -122.38
+              description: Longitude in degrees
+            - name: k
+              in: query
+              required: false
+              schema:
+                type: integer
+              example: 5
+              description: Number of airports to return, nearest first (default 10, at most 100)
+            - name: radius
+              in: query
+              required: false
+              schema:
+                type: number
+              example: 100
+              description: Only return airports within this many km
+        responses:
+            200:
+              description: Returns the nearest airports with their distance in km
+              content:
+                application/json:
+                  schema:
+                    $ref: '#/components/schemas/ResultList'
+                  example:
+                    context: ["A description of a geo index lookup"]
+                    data: [{"airportname": "San Francisco Intl", "faa": "SFO", "icao": "KSFO",
+                            "city": "San Francisco", "country": "United States", "distance": 0.53}]
+            400:
+              description: Returns an error for a missing or invalid location
+              content:
+                application/json:
+                    schema:
+                      $ref: '#/components/schemas/Error'
+        """
+        location = nearbyparameters()
+        if not isinstance(location, tuple):
+            return location
+        lat, lon, k, radius = location
+        within = f" within {radius:g} km" if radius else ""
+
+        if args.geo_search == 'index' and airportGeoIndex.loaded:
+            context = [f"Geo index lookup - in-memory k-d tree over inventory.airport: {k} nearest to "
+                       f"({lat:g}, {lon:g}){within}"]
+            airports = [{**airport, 'distance': round(distance, 3)}
+                        for distance, airport in airportGeoIndex.nearest(lat, lon, k, radius)]
+            return jsonify({'data': airports, 'context': context})
+
+        # Otherwise the query service computes the haversine distance to every
+        # airport with a location and sorts by it.
+
+        queryPrep = "SELECT airportname, faa, icao, city, country, distance \
+                    FROM `travel-sample`.inventory.airport \
+                    LET distance = 2 * $earthRadius * ASIN(SQRT(POWER(SIN(RADIANS(geo.lat - $lat) / 2), 2) + \
+                        COS(RADIANS($lat)) * COS(RADIANS(geo.lat)) * POWER(SIN(RADIANS(geo.lon - $lon) / 2), 2))) \
+                    WHERE geo IS VALUED AND ($radius = 0 OR distance <= $radius) \
+                    ORDER BY distance LIMIT $k"
+        with timed('query'):
+            results = runquery(cluster, 'nearby-airports', queryPrep, earthRadius=earthRadius, lat=lat, lon=lon,
+                               radius=radius, k=k)
+            airports = [{**airport, 'distance': round(airport['distance'], 3)} for airport in results]
+        return jsonify({'data': airports, 'context': ["SQL++ query - scoped to inventory: " + queryPrep]})
+
+    @api.route('/hotels/nearby', methods=['GET', 'OPTIONS'])
+    @cross_origin(supports_credentials=True)
+    def nearbyhotels():
+        """Returns the hotels nearest to a location
+        ---
+        tags:
+        - hotels
+        parameters:
+            - name: lat
+              in: query
+              required: true
+              schema:
+                type: number
+              example: 37.78
+              description: Latitude in degrees
+            - name: lon
+              in: query
+              required: true
+              schema:
+                type: number
+              example: -122.41
+              description: Longitude in degrees
+            - name: k
+              in: query
+              required: false
+              schema:
+                type: integer
+              example: 5
+              description: Number of hotels to return, nearest first (default 10, at most 100)
+            - name: radius
+              in: query
+              required: false
+              schema:
+                type: number
+              example: 2
+              description: Only return hotels within this many km
+        responses:
+            200:
+              description: Returns the nearest hotels with their distance in km
+              content:
+                application/json:
+                  schema:
+                    $ref: '#/components/schemas/ResultList'
+                  example:
+                    context: ["A description of a geo index lookup"]
+                    data: [{"name": "Hotel Nikko", "description": "Hotel in Union Square.",
+                            "address": "222 Mason St, San Francisco, California, United States", "distance": 0.41}]
+            400:
+              description: Returns an error for a missing or invalid location
+              content:
+                application/json:
+                    schema:
+                      $ref: '#/components/schemas/Error'
+        """
+        location = nearbyparameters()
+        if not isinstance(location, tuple):
+            return location
+        lat, lon, k, radius = location
+        within = f" within {radius:g} km" if radius else ""
+
+        if args.geo_search == 'index' and hotelGeoIndex.loaded:
+            context = [f"Geo index lookup - in-memory k-d tree over inventory.hotel: {k} nearest to "
+                       f"({lat:g}, {lon:g}){within}"]
+            hotels = [{**hotel, 'distance': round(distance, 3)}
+                      for distance, hotel in hotelGeoIndex.nearest(lat, lon, k, radius)]
+            return jsonify({'data': hotels, 'context': context})
+
+        # Otherwise an FTS geo distance query, sorted by distance, finds the
+        # hotels (the 'geo' field is mapped as a geopoint in
+        # 'fts-hotels-index.json'), and their fields are looked up as for a
+        # hotel search. A geo distance query needs a distance, so without a
+        # radius it covers the whole globe.
+
+        import couchbase.search as FT
+
+        queryPrep = FT.GeoDistanceQuery(f"{radius or math.pi * earthRadius:g}km", (lon, lat), field='geo')
+        searchOptions = SearchOptions(limit=k, sort=[FT.SortGeoDistance(location=(lon, lat), field='geo', unit='km')],
+                                      **deadlineoptions())
+        hotelFields = [*hotelAddressFields, *hotelDataFields, 'geo']
+        with timed('search'):
+            hits = [hotel.id for hotel in cluster.search_query('hotels-index', queryPrep, searchOptions)]
+        with timed('kv'):
+            lookupFields = lookuphotels(collectionHandles.collection('inventory', 'hotel'), hits, hotelFields)
+
+        hotels = []
+        for hotelId in hits:
+            fields = lookupFields.get(hotelId)
+            if fields is None or 'geo' not in fields:
+                continue
+            hotels.append({**hotelrow(fields), 'distance': round(geodistance(lat, lon, fields['geo']), 3)})
+        context = [f"FTS geo search - scoped to: inventory.hotel: {k} nearest to ({lat:g}, {lon:g}){within}",
+                   f"KV sub-document get - scoped to inventory.hotel: for {len(hits)} documents, "
+                   f"{args.hotel_lookup_workers} at a time"]
+        page = {'partial': True} if len(hotels) < len(hits) else {}
+        return jsonify({'data': hotels, 'context': context, **page})
+
+
+def nearbyparameters():
+    """Returns the (lat, lon, k, radius) of a nearby lookup, or an error response"""
+    lat = request.args.get('lat', type=float)
+    lon = request.args.get('lon', type=float)
+    if lat is None or lon is None or not -90 <= lat <= 90 or not -180 <= lon <= 180:
+        return abortmsg(400, "lat and lon must be a latitude and longitude in degrees")
+    k = request.args.get('k', 10, type=int)
+    radius = request.args.get('radius', 0.0, type=float)
+    if not 1 <= k <= 100 or not 0 <= radius < math.inf:
+        return abortmsg(400, "k must be between 1 and 100, and radius a positive number of km")
+    return lat, lon, k, radius
+
+
+hotelLookupPool = None
+hotelCache = None
+hedgePool = None
+hedgeSlots = None
+
+
+def lookuphotels(collection, keys, fields):
+    """Returns {key: {field: value}} for the fields present in each hotel
+
+    Lookups that have not finished by the request's deadline are abandoned,
+    so their hotels are missing from the result, as are those that failed.
+    """
+    try:
+        options = deadlineoptions()
+    except DeadlineExceeded:
+        return {}
+
+    def lookup(key):
+        try:
+            result = collection.lookup_in(key, [SD.get(x) for x in fields], LookupInOptions(**options))
+        except CouchbaseException as e:
+            print(f"Failed to look up hotel {key}: {e}", flush=True)
+            return key, None
+
+        # The lookup will succeed even if the document does not contain all
+        # fields. Attempting to read these non-existent fields will raise an
+        # exception, so they are skipped.
+
+        values = {}
+        for x, field in enumerate(fields):
+            try:
+                values[field] = result.content_as[dict if field == 'geo' else str](x)
+            except Exception:
+                pass
+        return key, values
+
+    lookups = [hotelLookupPool.submit(lookup, key) for key in keys]
+    done, abandoned = wait(lookups, options['timeout'].total_seconds() if options else None)
+    for future in abandoned:
+        future.cancel()
+    return {key: values for key, values in (future.result() for future in lookups if future in done)
+            if values is not None}
+
+
+def bookingsapplied(users, user, keys):
+    """Returns whether booking keys were appended to a user, or None if that cannot be read
+
+    The read is not bound by the request's deadline, which has usually
+    passed by the time it is needed.
+    """
+    try:
+        with timed('kv'):
+            result = users.lookup_in(user, (SD.get('bookings'),))
+    except CouchbaseException as e:
+        result = e
+    return bookingsfound(result, user, keys)
+
+
+def bookingsfound(result, user, keys):
+    """Returns whether booking keys are in a read of a user's bookings, or None if the read failed
+
+    `result` is that of looking up `bookings` in the user, or the exception the lookup raised.
+    """
+    try:
+        if isinstance(result, Exception):
+            raise result
+        userBookings = result.content_as[list](0)
+    except PathNotFoundException:
+        return False
+    except CouchbaseException as e:
+        print(f"Failed to read back the bookings of {user}: {e}", flush=True)
+        return None
+    return not set(keys).isdisjoint(userBookings)
+
+
+def removebookings(bookings, keys):
+    """Removes booking documents that could not be added to a user"""
+    try:
+        with timed('kv'):
+            removeResults = bookings.remove_multi(keys)
+    except CouchbaseException as e:
+        print(f"Failed to remove bookings {', '.join(keys)}: {e}", flush=True)
+        return
+    for key, e in removeResults.exceptions.items():
+        print(f"Failed to remove booking {key}: {e}", flush=True)
+
+
+class HedgeDelay:
+    """Times the active reads of one kind, to tell when one is slow enough to hedge
+
+    The delay is the `--hedge-percentile` of the last `size` read times, and
+    is worked out again every `every` reads rather than on each one.
+    """
+
+    size = 512
+    every = 64
+
+    def __init__(self, read):
+        self.labels = (('read', read),)
+        self.samples = deque(maxlen=self.size)
+        self.count = 0
+        self.delay = None
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+            self.count += 1
+            if self.count % self.every:
+                return
+            ordered = sorted(self.samples)
+        self.delay = ordered[min(len(ordered) - 1, int(len(ordered) * args.hedge_percentile / 100))]
+        metrics.set('travel_hedge_delay_seconds', self.labels, self.delay)
+
+    def current(self):
+        return args.hedge_delay / 1000 if self.delay is None else self.delay
+
+
+hedgeDelays = {}
+
+
+def hedged(read, active, replica):
+    """Returns active(), or replica() if the active read is slow and the replica answers first
+
+    With `--hedge replica`, a read still running after its hedge delay is
+    raced against a replica read. A replica may lag behind the active node,
+    so only reads that tolerate a slightly stale answer are hedged. A failed
+    replica read is ignored, and the active read's answer, be it a result or
+    an exception, is returned.
+
+    Reads only go to `hedgePool` while it has a free thread, so they never
+    wait in its queue, and the hedge delay is timed from when the active
+    read starts. When every thread is busy, the active read is made on the
+    request thread and is not hedged.
+    """
+    if args.hedge == 'off' or not hedgeSlots.acquire(blocking=False):
+        return active()
+    delay = hedgeDelays.get(read)
+    if delay is None:
+        delay = hedgeDelays.setdefault(read, HedgeDelay(read))
+
+    activeStarted = threading.Event()
+    startedAt = []
+
+    def timedactive():
+        startedAt.append(time.perf_counter())
+        activeStarted.set()
+        try:
+            return active()
+        finally:
+            delay.observe(time.perf_counter() - startedAt[0])
+
+    activeRead = hedgePool.submit(timedactive)
+    activeRead.add_done_callback(lambda future: hedgeSlots.release())
+    activeStarted.wait()
+    done, _ = wait([activeRead], max(0, delay.current() - (time.perf_counter() - startedAt[0])))
+    if done or not hedgeSlots.acquire(blocking=False):
+        return activeRead.result()
+
+    metrics.inc('travel_hedges_fired_total', delay.labels)
+    replicaRead = hedgePool.submit(replica)
+    replicaRead.add_done_callback(lambda future: hedgeSlots.release())
+    done, _ = wait([activeRead, replicaRead], return_when=FIRST_COMPLETED)
+    if activeRead not in done and replicaRead.exception() is None:
+        metrics.inc('travel_hedges_won_total', delay.labels)
+        return replicaRead.result()
+    return activeRead.result()
+
+
+def streamhotels(searchRows, collection, fields, context, page):
+    """Yields the fields of each search hit, in search order
+
+    Hits without stored fields are looked up `--hotel-lookup-workers` at a
+    time, so the hits after one are held back until its batch is complete.
+    Sets page['partial'] if any could not be looked up.
+    """
+    pending = []
+    lookups = 0
+    searchTime = 0
+    rowIterator = iter(searchRows)
+    while True:
+        start = time.perf_counter()
+        hotel = next(rowIterator, None)
+        searchTime += time.perf_counter() - start
+        if hotel is not None:
+            pending.append((hotel.id, dict(hotel.fields) if hotel.fields else None))
+
+        missingHits = [hotelId for hotelId, stored in pending if stored is None]
+        if hotel is None or not missingHits or len(missingHits) >= args.hotel_lookup_workers:
+            lookupFields = {}
+            if missingHits:
+                with timed('kv'):
+                    lookupFields = lookuphotels(collection, missingHits, fields)
+                lookups += len(missingHits)
+                if len(lookupFields) < len(missingHits):
+                    page['partial'] = True
+            for hotelId, stored in pending:
+                values = stored or lookupFields.get(hotelId)
+                if values is not None:
+                    yield values
+            pending = []
+
+        if hotel is None:
+            break
+
+    recordoperation('search', searchTime)
+    if lookups:
+        context.append(f"KV sub-document get - scoped to inventory.{collection.name}: for {lookups} documents, "
+                       f"{args.hotel_lookup_workers} at a time")
+
+
+def paginate(rows, limit, cursorvalues, page):
+    """Yields up to `limit` rows, setting page['next'] if there are more
+
+    `rows` should hold one row more than a page, whose presence shows there
+    is a next page. The cursor for it is made from `cursorvalues(row)` of
+    the last row on this page.
+    """
+    lastValues = None
+    for count, row in enumerate(rows):
+        if limit and count == limit:
+            page['next'] = encodecursor(lastValues)
+            break
+        lastValues = cursorvalues(row)
+        yield row
+
+
+def encodecursor(values):
+    """Returns an opaque cursor holding a list of keyset values"""
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decodecursor(cursor, size):
+    """Returns the list of `size` string keyset values held in a cursor, or None if it is malformed"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except ValueError:
+        return None
+    if not isinstance(values, list) or len(values) != size or not all(isinstance(value, str) for value in values):
+        return None
+    return values
+
+
+def parselimit(value):
+    """Returns a 'limit' parameter as a positive int, 0 if it is absent, or None if it is invalid"""
+    if value is None:
+        return 0
+    try:
+        limit = int(value)
+    except ValueError:
+        return None
+    return limit if limit > 0 else None
 
 
 def abortmsg(code, message):
@@ -841,30 +3215,311 @@ def abortmsg(code, message):
     return response
 
 
+def priced(routes):
+    """Yields each route with a random price added, as the sample data has none"""
+    for route in routes:
+        route['price'] = math.ceil(random() * 500) + 250
+        yield route
+
+
 def convdate(rawdate):
     """Returns integer data from mm/dd/YYYY"""
     day = datetime.strptime(rawdate, '%m/%d/%Y')
     return day.weekday()
 
 
-def genToken(username):
-    return jwt.encode({'user': username}, JWT_SECRET, algorithm='HS256').decode("ascii")
+# Verifying a token's signature on every request is avoided by caching the
+# username of each verified token until the token expires. A token is only
+# cached once it has been verified, so a malformed or forged one never is.
+
+tokenCache = LRUCache('tokens', 10000, 86400)
+issuedTokenCache = LRUCache('issued-tokens', 10000, 43200)
 
 
-def auth(bearerHeader, username):
-    bearer = bearerHeader.split(" ")[1]
-    return username == jwt.decode(bearer, JWT_SECRET)['user']
+def genToken(username):
+    """Returns a token for username, reusing one issued in the last half of its lifetime"""
+    token = issuedTokenCache.get(username)
+    if token is None:
+        expires = datetime.utcnow() + timedelta(seconds=args.token_ttl)
+        with timed('jwt'):
+            token = jwt.encode({'user': username, 'exp': expires}, JWT_SECRET, algorithm='HS256').decode("ascii")
+        issuedTokenCache.set(username, token, ttl=args.token_ttl / 2)
+        tokenCache.set(token, username, ttl=args.token_ttl)
+    return token
+
+
+def tokenuser(bearerHeader):
+    """Returns the username of a valid 'Bearer <token>' header, otherwise None"""
+    parts = (bearerHeader or '').split(" ")
+    if len(parts) != 2 or parts[0].lower() != 'bearer' or not parts[1]:
+        return None
+
+    bearer = parts[1]
+    username = tokenCache.get(bearer)
+    if username is None:
+        try:
+            with timed('jwt'):
+                claims = jwt.decode(bearer, JWT_SECRET, algorithms=['HS256'], options={'require_exp': True})
+        except jwt.InvalidTokenError:
+            return None
+        username = claims.get('user')
+        if username is None:
+            return None
+        tokenCache.set(bearer, username, ttl=claims['exp'] - time.time())
+    return username
+
+
+def operatorerror(bearerHeader):
+    """Returns the (status, message) of an error unless the header carries the operator token, otherwise None"""
+    if not args.admin_token:
+        return 403, "Operator endpoints are disabled, as no --admin-token is set"
+    parts = (bearerHeader or '').split(" ")
+    if len(parts) != 2 or parts[0].lower() != 'bearer' or \
+            not hmac.compare_digest(parts[1].encode('utf-8'), args.admin_token.encode('utf-8')):
+        return 401, 'Missing or invalid operator token'
+    return None
 
 
 def connect_db():
-    print(CONNSTR, authenticator)
+    print(CONNSTR)
     cluster = Cluster(CONNSTR, ClusterOptions(authenticator))
     bucket = cluster.bucket('travel-sample')
     return cluster, bucket
 
 
-if __name__ == "__main__":
+# Each process opens its own cluster connection, as a connection cannot be
+# shared with a forked child. Under the production server every worker
+# connects right after it is forked; under any other WSGI server a worker
+# connects on its first request.
+
+cluster = None
+bucket = None
+connectLock = threading.Lock()
+ready = threading.Event()
+
+# The warm-up runs a request to each search endpoint through its view, so the
+# query service has prepared the statements, the search index is loaded and
+# the FAA code and hotel caches hold the frontend's default searches before
+# the first caller arrives.
+
+warmupRequests = [
+    '/api/airports?search=San',
+    '/api/flightPaths/San Francisco Intl/Los Angeles Intl?leave=05/24/2021',
+    '/api/hotels/*/San Francisco/',
+]
+
+
+def connect_worker():
+    """Connects this process to the cluster, loads the in-memory indexes and warms up"""
+    global cluster, bucket
+    if cluster is not None:
+        # An earlier attempt failed part way through
+        cluster.close()
     cluster, bucket = connect_db()
-    app.register_blueprint(api, url_prefix="/api")
-    swagger = Swagger(app, template=swagger_template)
-    app.run(debug=True, host='0.0.0.0', port=8080, threaded=False)
\ No newline at end of file
+    if args.ready_timeout:
+        started = time.perf_counter()
+        cluster.wait_until_ready(timedelta(seconds=args.ready_timeout), WaitUntilReadyOptions(
+            service_types=[ServiceType.KeyValue, ServiceType.Query, ServiceType.Search]))
+        print(f"KV, query and search services ready after {time.perf_counter() - started:.3f}s", flush=True)
+    collectionHandles.reset()
+    collectionHandles.preload([lowercase(tenant) for tenant in args.tenants.split(',') if tenant])
+    if args.airport_search == 'index':
+        airportIndex.load(cluster)
+    if args.route_search == 'index':
+        routeIndex.load(cluster)
+    if args.geo_search == 'index':
+        airportGeoIndex.load(cluster)
+        hotelGeoIndex.load(cluster)
+    if args.warmup == 'requests':
+        warmup()
+    ready.set()
+    metrics.set('travel_startup_seconds', (('phase', 'ready'),), time.perf_counter() - importStarted)
+
+
+def warmup():
+    """Runs the warm-up requests, logging rather than raising their failures
+
+    Each request gets an app context of its own, so that nothing it leaves
+    in `g`, such as its timings, can reach a real request.
+    """
+    started = time.perf_counter()
+    for path in warmupRequests:
+        with app.app_context(), app.test_request_context(path):
+            try:
+                response = app.make_response(app.dispatch_request())
+                response.get_data()
+            except Exception as e:
+                print(f"Warm-up request {path} failed: {e!r}", flush=True)
+                continue
+        if response.status_code != 200:
+            print(f"Warm-up request {path} returned {response.status_code}", flush=True)
+    print(f"Warmed up in {time.perf_counter() - started:.3f}s", flush=True)
+
+
+def disconnect_worker():
+    """Finishes in-flight hotel lookups and closes the cluster connection"""
+    global cluster, bucket
+    ready.clear()
+    hotelLookupPool.shutdown(wait=True)
+    hedgePool.shutdown(wait=True)
+    if cluster is not None:
+        cluster.close()
+    cluster, bucket = None, None
+    collectionHandles.reset()
+
+
+def reset_after_fork():
+    global cluster, bucket, hotelLookupPool, hedgePool, hedgeSlots, ready
+    cluster, bucket = None, None
+    ready = threading.Event()
+    hotelLookupPool = ThreadPoolExecutor(max_workers=args.hotel_lookup_workers)
+    hedgePool = ThreadPoolExecutor(max_workers=args.hedge_workers)
+    hedgeSlots = threading.BoundedSemaphore(args.hedge_workers)
+
+
+os.register_at_fork(after_in_child=reset_after_fork)
+
+
+def connect_once():
+    if not ready.is_set():
+        with connectLock:
+            if not ready.is_set():
+                connect_worker()
+
+
+# The health checks never connect themselves, so a load balancer can tell a
+# live process that is still warming up from one that is ready for traffic.
+# '/metrics' is answered throughout as well, so a slow startup can be
+# watched. Requests never connect either: until the process is ready they
+# start the connection and warm-up in the background, if it is not already
+# under way, and are answered with a 503.
+
+healthChecks = ('liveness', 'readiness', 'metricsendpoint')
+
+
+@app.before_request
+def ensure_connected():
+    if request.endpoint not in healthChecks and not ready.is_set():
+        connectinbackground()
+        response = jsonify({'message': "The service is warming up"})
+        response.status_code = 503
+        response.headers['Retry-After'] = '1'
+        return response
+
+
+@app.route('/health/live')
+def liveness():
+    """Reports that the process is up
+    ---
+    responses:
+        200:
+          description: The process is serving requests
+          content:
+            application/json:
+              example: {"status": "live"}
+    """
+    return jsonify({'status': 'live'})
+
+
+@app.route('/health/ready')
+def readiness():
+    """Reports whether the process is connected and warmed up
+    ---
+    responses:
+        200:
+          description: The services are ready, and the indexes and warm-up requests have been loaded
+          content:
+            application/json:
+              example: {"status": "ready"}
+        503:
+          description: The process is still connecting or warming up, or is shutting down
+          content:
+            application/json:
+              example: {"status": "warming up"}
+    """
+    if ready.is_set():
+        return jsonify({'status': 'ready'})
+    connectinbackground()
+    return jsonify({'status': 'warming up'}), 503
+
+
+def connectinbackground():
+    """Connects and warms up in a background thread, unless that is already under way"""
+    if not connectLock.locked():
+        threading.Thread(target=connectinthread, daemon=True).start()
+
+
+def connectinthread():
+    try:
+        connect_once()
+    except Exception as e:
+        print(f"Connecting failed: {e!r}", flush=True)
+
+
+def create_app(argv=()):
+    """Returns the configured Flask app, e.g. `gunicorn 'travel:create_app()'`
+
+    With no arguments the connection details are read from the CB_HOST,
+    CB_USER and CB_PSWD environment variables.
+    """
+    global hotelLookupPool, hedgePool, hedgeSlots, hotelCache
+    configure(argv)
+    hotelLookupPool = ThreadPoolExecutor(max_workers=args.hotel_lookup_workers)
+    hedgePool = ThreadPoolExecutor(max_workers=args.hedge_workers)
+    hedgeSlots = threading.BoundedSemaphore(args.hedge_workers)
+    if args.hotel_cache == 'memory':
+        hotelCache = LRUCache('hotels', args.hotel_cache_size, args.hotel_cache_ttl, args.hotel_cache_bytes)
+    elif args.hotel_cache == 'couchbase':
+        hotelCache = CouchbaseCache('hotels', args.hotel_cache_ttl, *args.hotel_cache_collection.split('.'))
+    if 'api' not in app.blueprints:
+        app.register_blueprint(api, url_prefix="/api")
+        if args.apidocs == 'generated':
+            from flasgger import Swagger
+            Swagger(app, template=swagger_template)
+        else:
+            app.wsgi_app = PrebuiltApiDocs(app.wsgi_app, os.path.join(os.path.dirname(__file__), 'swagger.json'))
+    metrics.set('travel_startup_seconds', (('phase', 'configured'),), time.perf_counter() - importStarted)
+    return app
+
+
+def serve():
+    """Runs the app under gunicorn with `--workers` processes of `--threads` threads
+
+    Each worker connects and warms up in the background once it is forked,
+    so it answers the health checks while it starts, and gunicorn's worker
+    timeout does not have to allow for `--ready-timeout`.
+    """
+    global serverThreads
+    from gunicorn.app.base import BaseApplication
+
+    # Each request, waiting or not, holds one of the threads of a worker, so
+    # a limit that is not below --threads could never be reached.
+
+    for option in ('route_concurrency', 'tenant_concurrency'):
+        if getattr(args, option) >= args.threads:
+            parser.error(f"--{option.replace('_', '-')} must be below --threads ({args.threads})")
+    serverThreads = args.threads
+
+    class TravelApplication(BaseApplication):
+
+        def load_config(self):
+            self.cfg.set('bind', f"0.0.0.0:{args.port}")
+            self.cfg.set('workers', args.workers)
+            self.cfg.set('threads', args.threads)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('post_fork', lambda server, worker: connectinbackground())
+            self.cfg.set('worker_exit', lambda server, worker: disconnect_worker())
+
+        def load(self):
+            return app
+
+    TravelApplication().run()
+
+
+if __name__ == "__main__":
+    create_app(sys.argv[1:])
+    if args.server == 'production':
+        serve()
+    else:
+        connectinbackground()
+        app.run(debug=True, host='0.0.0.0', port=args.port, threaded=False)
@@ -0,0 +1,781 @@
+import asyncio
+import math
+import sys
+import time
+import uuid
+from contextlib import asynccontextmanager
+from datetime import timedelta
+from random import random
+from urllib.parse import unquote, urlsplit
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.requests import Request
+from starlette.responses import HTMLResponse, JSONResponse, PlainTextResponse
+from starlette.routing import Match, Route
+
+# Couchbase Imports
+import couchbase.search as FT
+import couchbase.subdocument as SD
+from acouchbase.cluster import Cluster
+from couchbase.diagnostics import ServiceType
+from couchbase.options import ClusterOptions, SearchOptions, WaitUntilReadyOptions
+from couchbase.management.options import GetAllScopesOptions
+from couchbase.exceptions import *
+
+# The command line options, the in-memory indexes and the caches are shared
+# with the Flask application in `travel.py`. See there for a walk through of
+# each endpoint; this file serves the same `/api` routes and JSON responses,
+# apart from those listed in the README, on the asyncio cluster from
+# `acouchbase`, so one process can hold many requests in flight while they
+# wait on Couchbase. Lookups that do not depend on each other are issued
+# together with `asyncio.gather`.
+#
+# Start it with the same options as `travel.py`:
+#   python3 travel_async.py -c $CB_HOST -u $CB_USER -p $CB_PSWD
+# or under any ASGI server, with the connection details in the environment:
+#   uvicorn --factory travel_async:create_app
+
+import travel
+from travel import (args, airportIndex, routeIndex, faaCache, caches, collectionHandles, metrics,
+                    bookingsfound, convdate, decodecursor, genToken, lowercase, operatorerror, paginate, parselimit,
+                    runquery, timeoutErrors, tokenuser)
+
+cluster = None
+bucket = None
+ready = False
+
+# The event loop only keeps weak references to tasks, so background route
+# index rebuilds are kept here until they finish.
+
+rebuildTasks = set()
+
+# Listing the scopes of the bucket to check tenant names is shared by every
+# request, as in `travel.CollectionHandles`, whose state is reused.
+
+scopesLock = asyncio.Lock()
+
+
+async def index(request):
+    return HTMLResponse("""
+    <h1> Python Travel Sample API (asyncio) </h1>
+    A sample API for getting started with Couchbase Server and the Python SDK.
+    <ul>
+    <li> <a href = "https://github.com/couchbaselabs/try-cb-python"> GitHub </a>
+    </ul>
+    """)
+
+
+async def airports(request):
+    queryType = "SQL++ query - scoped to inventory: "
+    partialAirportName = request.query_params['search']
+
+    queryPrep = "SELECT airportname FROM `travel-sample`.inventory.airport WHERE "
+    sameCase = partialAirportName == partialAirportName.lower() or partialAirportName == partialAirportName.upper() #bool
+
+    if sameCase and len(partialAirportName) == 3:
+        searchField = 'faa'
+    elif sameCase and len(partialAirportName) == 4:
+        searchField = 'icao'
+    else:
+        searchField = 'airportname'
+
+    limit = parselimit(request.query_params.get('limit'))
+    if limit is None:
+        return abortmsg(400, "limit must be a positive integer")
+    after = None
+    if 'cursor' in request.query_params:
+        after = decodecursor(request.query_params['cursor'], 3)
+        if after is None:
+            return abortmsg(400, "Invalid cursor")
+    page = {}
+
+    if args.airport_search == 'index' and airportIndex.loaded:
+        pageLimit = min(limit, args.airport_limit or limit)
+        keys = airportIndex.match(searchField, partialAirportName,
+                                  pageLimit + 1 if pageLimit else args.airport_limit, after)
+        airports = [{'airportname': name} for _, name, _ in paginate(keys, pageLimit, list, page)]
+        context = [f"Prefix index lookup - in-memory copy of inventory.airport: {searchField} matching "
+                   f"'{partialAirportName}'"]
+        return JSONResponse({"data": airports, "context": context, **page})
+
+    if limit or after is not None:
+        queryPrep = "SELECT airportname, [LOWER(airportname), airportname, META().id] AS cursor \
+                    FROM `travel-sample`.inventory.airport WHERE "
+
+    if searchField == 'airportname':
+        queryPrep += "POSITION(LOWER(airportname), $1) = 0"
+        queryArgs = [partialAirportName.lower()]
+    else:
+        queryPrep += f"{searchField}=$1"
+        queryArgs = [partialAirportName.upper()]
+
+    if limit or after is not None:
+        if after is not None:
+            queryPrep += " AND [LOWER(airportname), airportname, META().id] > $2"
+            queryArgs.append(after)
+        queryPrep += " ORDER BY LOWER(airportname), airportname, META().id"
+        if limit:
+            queryArgs.append(limit + 1)
+            queryPrep += f" LIMIT ${len(queryArgs)}"
+
+    results = runquery(cluster, 'airports', queryPrep, *queryArgs)
+    airports = [x async for x in results]
+
+    if limit or after is not None:
+        airports = [{'airportname': row['airportname']}
+                    for row in paginate(airports, limit, lambda row: row['cursor'], page)]
+
+    context = [queryType + queryPrep]
+    return JSONResponse({"data": airports, "context": context, **page})
+
+
+async def flightPaths(request):
+    fromLoc = request.path_params['fromLoc']
+    toLoc = request.path_params['toLoc']
+
+    queryType = "SQL++ query - scoped to inventory: "
+    context = []
+
+    faaCodes = {name: faaCache.get(name) for name in (fromLoc, toLoc)}
+    missingNames = sorted({name for name, faa in faaCodes.items() if faa is None})
+
+    if missingNames:
+        faaQueryPrep = "SELECT airportname, faa FROM `travel-sample`.inventory.airport \
+                        WHERE airportname IN $1"
+        faaResults = runquery(cluster, 'faa', faaQueryPrep, missingNames)
+
+        async for result in faaResults:
+            faaCodes[result['airportname']] = result['faa'] or ''
+            faaCache.set(result['airportname'], result['faa'] or '')
+
+        context.append(queryType + faaQueryPrep)
+    else:
+        context.append(f"FAA cache hit - airport names resolved in-process: {fromLoc}, {toLoc}")
+
+    queryFrom = faaCodes.get(fromLoc)
+    queryTo = faaCodes.get(toLoc)
+    if not queryFrom or not queryTo:
+        return abortmsg(404, "Unknown airport: " + (toLoc if queryFrom else fromLoc))
+
+    routeQueryPrep = "SELECT a.name, s.flight, s.utc, r.sourceairport, r.destinationairport, r.equipment \
+                    FROM `travel-sample`.inventory.route AS r \
+                    UNNEST r.schedule AS s \
+                    JOIN `travel-sample`.inventory.airline AS a ON KEYS r.airlineid \
+                    WHERE r.sourceairport = $fromfaa AND r.destinationairport = $tofaa AND s.day = $dayofweek \
+                    ORDER BY a.name ASC;"
+
+    flightDay = convdate(request.query_params['leave'])
+
+    if args.route_search == 'index' and routeIndex.loaded:
+        if routeIndex.stale():
+            task = asyncio.create_task(rebuildroutes())
+            rebuildTasks.add(task)
+            task.add_done_callback(rebuildTasks.discard)
+        routesList = routeIndex.search(queryFrom, queryTo, flightDay)
+        for route in routesList:
+            route['price'] = math.ceil(random() * 500) + 250
+
+        context.append(f"Route index lookup - precomputed from inventory.route and inventory.airline: "
+                       f"sourceairport={queryFrom}, destinationairport={queryTo}, day={flightDay}")
+        return JSONResponse({"data": routesList, "context": context})
+
+    routeResults = runquery(cluster, 'routes', routeQueryPrep,
+                            fromfaa=queryFrom,
+                            tofaa=queryTo,
+                            dayofweek=flightDay)
+
+    routesList = []
+    async for route in routeResults:
+        route['price'] = math.ceil(random() * 500) + 250
+        routesList.append(route)
+
+    context.append(queryType + routeQueryPrep)
+    return JSONResponse({"data": routesList, "context": context})
+
+
+async def refreshFlightPaths(request):
+    error = operatorerror(request.headers.get('authorization'))
+    if error is not None:
+        return abortmsg(*error)
+    if not routeIndex.claim():
+        return abortmsg(409, "The route index is already being rebuilt")
+    try:
+        await loadindex(routeIndex)
+    finally:
+        routeIndex.rebuilding = False
+    return JSONResponse({'data': {'routes': len(routeIndex.schedules), 'flights': routeIndex.flights},
+                         'context': ["Route index rebuilt from inventory.route and inventory.airline"]})
+
+
+async def cachestats(request):
+    return JSONResponse({'data': {name: cache.stats() for name, cache in caches.items()},
+                         'context': ["In-process cache statistics"]})
+
+
+async def purgecache(request):
+    error = operatorerror(request.headers.get('authorization'))
+    if error is not None:
+        return abortmsg(*error)
+    name = request.path_params['name']
+    if name not in caches:
+        return abortmsg(404, "Unknown cache: " + name)
+    caches[name].clear()
+    return JSONResponse({'data': caches[name].stats(), 'context': [f"Purged cache {name}"]})
+
+
+async def metricsendpoint(request):
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
+
+
+async def knowntenant(tenant):
+    """Returns True unless tenant is not the name of a scope in the bucket, see `travel.CollectionHandles`"""
+    if not collectionHandles.scopeName.match(tenant):
+        return False
+    if collectionHandles.scopes is not None and tenant in collectionHandles.scopes:
+        return True
+    async with scopesLock:
+        if time.monotonic() - collectionHandles.scopesAt > collectionHandles.scopesTTL:
+            collectionHandles.scopesAt = time.monotonic()
+            try:
+                options = GetAllScopesOptions(timeout=collectionHandles.scopesTimeout)
+                collectionHandles.scopes = {scope.name for scope in await bucket.collections().get_all_scopes(options)}
+            except CouchbaseException as e:
+                print(f"Failed to list scopes, tenant names are not checked: {e}", flush=True)
+                collectionHandles.scopes = None
+        return collectionHandles.scopes is None or tenant in collectionHandles.scopes
+
+
+async def login(request):
+    tenant = request.path_params['tenant']
+    if not await knowntenant(lowercase(tenant)):
+        return abortmsg(404, "Unknown tenant: " + tenant)
+    requestBody = await request.json()
+    user = requestBody['user']
+    providedPassword = requestBody['password']
+
+    userDocumentKey = lowercase(user)
+
+    agent = lowercase(tenant)
+    scope = bucket.scope(agent)
+    users = scope.collection('users')
+
+    queryType = f"KV get - scoped to {scope.name}.users: for password field in document "
+
+    try:
+        lookupResult = await users.lookup_in(userDocumentKey, (
+            SD.get('password'),
+        ))
+        documentPassword = lookupResult.content_as[str](0)
+
+        if documentPassword != providedPassword:
+            return abortmsg(401, "Password does not match")
+
+    except DocumentNotFoundException:
+        print(f"User {user} item does not exist", flush=True)
+    else:
+        return JSONResponse({'data': {'token': genToken(user)}, 'context': [queryType + user]})
+
+    return abortmsg(401, "Failed to get user data")
+
+
+async def signup(request):
+    tenant = request.path_params['tenant']
+    if not await knowntenant(lowercase(tenant)):
+        return abortmsg(404, "Unknown tenant: " + tenant)
+    requestBody = await request.json()
+    user = requestBody['user']
+    password = requestBody['password']
+
+    userDocumentKey = lowercase(user)
+
+    agent = lowercase(tenant)
+    scope = bucket.scope(agent)
+    users = scope.collection('users')
+
+    queryType = f"KV insert - scoped to {scope.name}.users: document "
+
+    try:
+        await users.insert(userDocumentKey, {'username': user, 'password': password})
+        return JSONResponse({'data': {'token': genToken(user)}, 'context': [queryType + user]},
+                            status_code=201)
+
+    except DocumentExistsException:
+        print(f"User {user} item already exists", flush=True)
+        return abortmsg(409, "User already exists")
+    except timeoutErrors:
+        raise
+    except Exception as e:
+        print(e, flush=True)
+        return abortmsg(500, "Failed to save user")
+
+
+async def getflights(request):
+    tenant = request.path_params['tenant']
+    username = request.path_params['username']
+    if not await knowntenant(lowercase(tenant)):
+        return abortmsg(404, "Unknown tenant: " + tenant)
+    agent = lowercase(tenant)
+
+    scope = bucket.scope(agent)
+    users = scope.collection('users')
+    flights = scope.collection('bookings')
+
+    tokenUser = tokenuser(request.headers.get('Authorization'))
+    if tokenUser is None:
+        return abortmsg(401, 'Missing or invalid bearer token')
+    if tokenUser != username:
+        return abortmsg(401, 'Username does not match token username: ' + username)
+
+    limit = parselimit(request.query_params.get('limit'))
+    if limit is None:
+        return abortmsg(400, "limit must be a positive integer")
+
+    try:
+        userDocumentKey = lowercase(username)
+
+        lookupResult = await users.lookup_in(
+          userDocumentKey,
+          [
+            SD.get('bookings'),
+            SD.exists('bookings')
+          ])
+
+        bookedFlightKeys = []
+        if lookupResult.exists(1):
+            bookedFlightKeys = lookupResult.content_as[list](0)
+
+        since = request.query_params.get('since')
+        if since is not None:
+            if since not in bookedFlightKeys:
+                return abortmsg(400, "Unknown booking in since: " + since)
+            bookedFlightKeys = bookedFlightKeys[bookedFlightKeys.index(since) + 1:]
+        nextKey = None
+        if limit and len(bookedFlightKeys) > limit:
+            bookedFlightKeys = bookedFlightKeys[:limit]
+            nextKey = bookedFlightKeys[-1]
+
+        # Every booking GET is in flight at the same time.
+
+        bookingResults = await asyncio.gather(*[flights.get(key) for key in bookedFlightKeys],
+                                              return_exceptions=True)
+
+        rows = []
+        failedKeys = []
+        for key, result in zip(bookedFlightKeys, bookingResults):
+            if isinstance(result, Exception):
+                print(f"Failed to get booking {key}: {result}", flush=True)
+                failedKeys.append(key)
+            else:
+                rows.append(result.content_as[dict])
+
+        queryType = f"KV get - scoped to {scope.name}.users: for {len(bookedFlightKeys)} bookings in document "
+        context = [queryType + userDocumentKey]
+        if failedKeys:
+            context.append(f"KV get failed - scoped to {scope.name}.bookings: for documents {', '.join(failedKeys)}")
+
+        responseJSON = {"data": rows, "context": context}
+        if failedKeys:
+            responseJSON['partial'] = True
+        if nextKey:
+            responseJSON['next'] = nextKey
+        return JSONResponse(responseJSON)
+
+    except DocumentNotFoundException:
+        return abortmsg(401, "User does not exist")
+
+
+async def updateflights(request):
+    tenant = request.path_params['tenant']
+    username = request.path_params['username']
+    if not await knowntenant(lowercase(tenant)):
+        return abortmsg(404, "Unknown tenant: " + tenant)
+    agent = lowercase(tenant)
+    user = lowercase(username)
+
+    scope = bucket.scope(agent)
+    users = scope.collection('users')
+    bookings = scope.collection('bookings')
+
+    queryType = f"KV update - scoped to {scope.name}.users: for bookings field in document "
+
+    tokenUser = tokenuser(request.headers.get('Authorization'))
+    if tokenUser is None:
+        return abortmsg(401, 'Missing or invalid bearer token')
+    if tokenUser != username:
+        return abortmsg(401, 'Username does not match token username: ' + username)
+
+    try:
+        flights = (await request.json()).get('flights')
+    except ValueError:
+        flights = None
+    if not isinstance(flights, list) or not flights:
+        return abortmsg(400, "No flights to book")
+
+    # Every booking document is written at the same time, and all of their
+    # keys are appended to the user in one Sub-Document op.
+
+    bookingKeys = {str(uuid.uuid4()): flight for flight in flights if isinstance(flight, dict)}
+    failed = [{'flight': flight, 'error': "Flight details must be an object"}
+              for flight in flights if not isinstance(flight, dict)]
+
+    upsertResults = await asyncio.gather(
+        *[bookings.upsert(key, flight) for key, flight in bookingKeys.items()], return_exceptions=True)
+
+    written = []
+    for (key, flight), result in zip(bookingKeys.items(), upsertResults):
+        if isinstance(result, Exception):
+            print(f"Failed to add booking {key}: {result}", flush=True)
+            failed.append({'flight': flight, 'error': "Failed to add flight data"})
+        else:
+            written.append(key)
+
+    if not written:
+        return abortmsg(500, "Failed to add flight data")
+
+    # As in `travel.py`, the booking documents are only removed after the
+    # append definitely failed, and an ambiguous failure reads the user's
+    # bookings back to tell.
+
+    try:
+        await users.mutate_in(user, (SD.array_append('bookings', *written, create_parents=True),))
+    except (AmbiguousTimeoutException, RequestCanceledException) as e:
+        print(f"Ambiguous bookings update for {user}: {e}", flush=True)
+        try:
+            result = await users.lookup_in(user, (SD.get('bookings'),))
+        except CouchbaseException as lookupError:
+            result = lookupError
+        applied = bookingsfound(result, user, written)
+        if applied is None:
+            return abortmsg(504, "Request timed out, it is unknown whether the flights were booked")
+        if not applied:
+            await removebookings(bookings, written)
+            return abortmsg(504, "Request timed out, no flights were booked")
+    except Exception as e:
+        await removebookings(bookings, written)
+        if isinstance(e, DocumentNotFoundException):
+            return abortmsg(401, "User does not exist")
+        if isinstance(e, UnAmbiguousTimeoutException):
+            return abortmsg(504, "Request timed out, no flights were booked")
+        print(e, flush=True)
+        return abortmsg(500, "Couldn't update flights")
+
+    resultJSON = {'data': {'added': [bookingKeys[key] for key in written]},
+                  'context': [f"KV upsert - scoped to {scope.name}.bookings: {len(written)} documents at once",
+                              queryType + user]}
+    if failed:
+        resultJSON['data']['failed'] = failed
+    return JSONResponse(resultJSON)
+
+
+async def removebookings(bookings, keys):
+    """Removes booking documents that could not be added to a user"""
+    removeResults = await asyncio.gather(*[bookings.remove(key) for key in keys], return_exceptions=True)
+    for key, result in zip(keys, removeResults):
+        if isinstance(result, Exception):
+            print(f"Failed to remove booking {key}: {result}", flush=True)
+
+
+async def hotels(request):
+    description = request.path_params['description']
+    location = request.path_params['location']
+
+    limit = parselimit(request.query_params.get('limit'))
+    if limit is None:
+        return abortmsg(400, "limit must be a positive integer")
+    limit = min(limit or 100, 100)
+    after = None
+    if 'cursor' in request.query_params:
+        after = decodecursor(request.query_params['cursor'], 2)
+        if after is None:
+            return abortmsg(400, "Invalid cursor")
+    page = {}
+
+    queryPrep = FT.ConjunctionQuery()
+    if location != '*' and location != "":
+        queryPrep.conjuncts.append(
+            FT.DisjunctionQuery(
+                FT.MatchPhraseQuery(location, field='country'),
+                FT.MatchPhraseQuery(location, field='city'),
+                FT.MatchPhraseQuery(location, field='state'),
+                FT.MatchPhraseQuery(location, field='address')
+            ))
+
+    if description != '*' and description != "":
+        queryPrep.conjuncts.append(
+            FT.DisjunctionQuery(
+                FT.MatchPhraseQuery(description, field='description'),
+                FT.MatchPhraseQuery(description, field='name')
+            ))
+
+    if len(queryPrep.conjuncts) == 0:
+        queryType = "FTS search rejected - no search terms were provided"
+        return JSONResponse({'data': [], 'context': [queryType]})
+
+    addressFields = ['address', 'city', 'state', 'country']
+    dataFields = ['name', 'description']
+    hotelFields = [*addressFields, *dataFields]
+
+    hotelSort = ['-_score', '_id']
+    if args.hotel_search == 'stored':
+        searchOptions = SearchOptions(limit=limit + 1, sort=hotelSort, fields=hotelFields)
+    else:
+        searchOptions = SearchOptions(limit=limit + 1, sort=hotelSort)
+    if after is not None:
+        searchOptions['raw'] = {'search_after': after}
+
+    searchRows = cluster.search_query('hotels-index', queryPrep, searchOptions)
+    hotels = [hotel async for hotel in searchRows]
+    hits = []
+    storedFields = {}
+    for hotel in paginate(hotels, limit, lambda hotel: list(hotel.sort), page):
+        hits.append(hotel.id)
+        if hotel.fields:
+            storedFields[hotel.id] = dict(hotel.fields)
+
+    scope = bucket.scope('inventory')
+    hotel_collection = scope.collection('hotel')
+
+    # Every sub-document lookup is in flight at the same time.
+
+    missingHits = [hotelId for hotelId in hits if hotelId not in storedFields]
+    lookupResults = await asyncio.gather(
+        *[hotel_collection.lookup_in(hotelId, [SD.get(x) for x in hotelFields]) for hotelId in missingHits],
+        return_exceptions=True)
+
+    lookupFields = {}
+    for hotelId, result in zip(missingHits, lookupResults):
+        if isinstance(result, Exception):
+            print(f"Failed to look up hotel {hotelId}: {result}", flush=True)
+            continue
+        values = {}
+        for x, field in enumerate(hotelFields):
+            try:
+                values[field] = result.content_as[str](x)
+            except Exception:
+                pass
+        lookupFields[hotelId] = values
+
+    allResults = []
+    for hotelId in hits:
+        fields = storedFields.get(hotelId) or lookupFields.get(hotelId)
+        if fields is None:
+            continue
+
+        hotelData = {field: fields[field] for field in dataFields if field in fields}
+        hotelData['address'] = ', '.join(fields[field] for field in addressFields if field in fields)
+        allResults.append(hotelData)
+
+    queryType = f"FTS search - scoped to: {scope.name}.hotel within fields {','.join(hotelFields)}"
+    context = [queryType]
+    if missingHits:
+        context.append(f"KV sub-document get - scoped to {scope.name}.hotel: for {len(missingHits)} documents, "
+                       f"all at once")
+    if len(lookupFields) < len(missingHits):
+        page['partial'] = True
+    return JSONResponse({'data': allResults, 'context': context, **page})
+
+
+def abortmsg(code, message):
+    return JSONResponse({'message': message}, status_code=code)
+
+
+# As in `travel.py`, a request that hits an SDK timeout is answered with a 504.
+
+async def timedout(request, e):
+    print(f"Request timed out - has Couchbase stopped running? {e}", flush=True)
+    return abortmsg(504, "Request timed out")
+
+
+async def loadindex(index):
+    """Builds an in-memory index from its query, read on the asyncio cluster"""
+    index.build([row async for row in runquery(cluster, index.profile, index.statement)])
+
+
+async def rebuildroutes():
+    try:
+        await loadindex(routeIndex)
+    except CouchbaseException as e:
+        routeIndex.failed(e)
+    finally:
+        routeIndex.rebuilding = False
+
+
+async def warmup():
+    """Runs `travel.warmupRequests` through their handlers, logging their failures"""
+    for path in travel.warmupRequests:
+        url = urlsplit(path)
+        scope = {'type': 'http', 'method': 'GET', 'path': unquote(url.path),
+                 'query_string': url.query.encode(), 'headers': []}
+        for route in routes:
+            match, child = route.matches(scope)
+            if match == Match.FULL:
+                try:
+                    response = await route.endpoint(Request({**scope, **child}))
+                except Exception as e:
+                    print(f"Warm-up request {path} failed: {e!r}", flush=True)
+                    break
+                if response.status_code != 200:
+                    print(f"Warm-up request {path} returned {response.status_code}", flush=True)
+                break
+
+
+async def liveness(request):
+    return JSONResponse({'status': 'live'})
+
+
+async def readiness(request):
+    if ready:
+        return JSONResponse({'status': 'ready'})
+    connectinbackground()
+    return JSONResponse({'status': 'warming up'}, status_code=503)
+
+
+# As in `travel.py`, the server accepts connections at once, and connects
+# and warms up in the background. Until it is ready, requests other than the
+# health checks and '/metrics' are answered with a 503, and start connecting
+# again if an earlier attempt failed.
+
+connectTask = None
+healthPaths = ('/health/live', '/health/ready', '/metrics')
+
+
+async def connect():
+    """Connects to the cluster, loads the in-memory indexes and runs the warm-up requests"""
+    global cluster, bucket, ready
+    if cluster is None:
+        print(travel.CONNSTR)
+        cluster = await Cluster.connect(travel.CONNSTR, ClusterOptions(travel.authenticator))
+    if args.ready_timeout:
+        await cluster.wait_until_ready(timedelta(seconds=args.ready_timeout), WaitUntilReadyOptions(
+            service_types=[ServiceType.KeyValue, ServiceType.Query, ServiceType.Search]))
+    bucket = cluster.bucket('travel-sample')
+    await bucket.on_connect()
+    if args.airport_search == 'index':
+        await loadindex(airportIndex)
+    if args.route_search == 'index':
+        await loadindex(routeIndex)
+    if args.warmup == 'requests':
+        await warmup()
+    ready = True
+
+
+async def connectintask():
+    try:
+        await connect()
+    except Exception as e:
+        print(f"Connecting failed: {e!r}", flush=True)
+
+
+def connectinbackground():
+    """Connects and warms up in a background task, unless that is already under way"""
+    global connectTask
+    if not ready and (connectTask is None or connectTask.done()):
+        connectTask = asyncio.create_task(connectintask())
+
+
+class WarmingUp:
+    """Answers requests with a 503 until the process is ready, apart from those for `healthPaths`"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and not ready and scope['path'] not in healthPaths:
+            connectinbackground()
+            response = JSONResponse({'message': "The service is warming up"}, status_code=503,
+                                    headers={'Retry-After': '1'})
+            await response(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global ready
+    connectinbackground()
+    yield
+    ready = False
+    if connectTask is not None:
+        connectTask.cancel()
+    if cluster is not None:
+        await cluster.close()
+
+
+routes = [
+    Route('/', index),
+    Route('/health/live', liveness),
+    Route('/health/ready', readiness),
+    Route('/metrics', metricsendpoint),
+    Route('/api/airports', airports, methods=['GET']),
+    Route('/api/flightPaths/refresh', refreshFlightPaths, methods=['POST']),
+    Route('/api/flightPaths/{fromLoc}/{toLoc}', flightPaths, methods=['GET']),
+    Route('/api/caches', cachestats, methods=['GET']),
+    Route('/api/caches/{name}', purgecache, methods=['DELETE']),
+    Route('/api/tenants/{tenant}/user/login', login, methods=['POST']),
+    Route('/api/tenants/{tenant}/user/signup', signup, methods=['POST']),
+    Route('/api/tenants/{tenant}/user/{username}/flights', getflights, methods=['GET']),
+    Route('/api/tenants/{tenant}/user/{username}/flights', updateflights, methods=['PUT']),
+    Route('/api/hotels/{description}/{location}/', hotels, methods=['GET']),
+]
+
+class RequestMetrics:
+    """Records the requests of the app in `travel.metrics`, labelled with their route as in `travel.py`"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        rule = next((route.path for route in routes if route.matches(scope)[0] == Match.FULL), 'unmatched')
+        labels = (('route', rule), ('method', scope['method']))
+        status = 500
+
+        async def sendstatus(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        metrics.add('travel_http_requests_in_flight', labels, 1)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, sendstatus)
+        finally:
+            metrics.observe('travel_http_request_duration_seconds', labels, time.perf_counter() - start)
+            metrics.inc('travel_http_requests_total', labels + (('status', status),))
+            if status >= 500:
+                metrics.inc('travel_http_request_errors_total', labels)
+            metrics.add('travel_http_requests_in_flight', labels, -1)
+
+
+middleware = [
+    Middleware(RequestMetrics),
+    Middleware(CORSMiddleware, allow_origin_regex='.*', allow_credentials=True,
+               allow_methods=['GET', 'POST', 'PUT', 'DELETE', 'OPTIONS'],
+               allow_headers=['Content-Type', 'Authorization']),
+    Middleware(WarmingUp)
+]
+
+
+
+def create_app(argv=()):
+    """Returns the configured Starlette app, see `travel.create_app`"""
+    travel.configure(argv)
+
+    # Starlette's middleware only offers gzip, whatever `--compression` allows
+    compression = []
+    if 'gzip' in travel.encodings:
+        compression = [Middleware(GZipMiddleware, minimum_size=args.compression_min_size,
+                                  compresslevel=min(args.compression_level, 9))]
+    return Starlette(routes=routes, middleware=middleware + compression, lifespan=lifespan,
+                     exception_handlers={error: timedout for error in timeoutErrors})
+
+
+if __name__ == "__main__":
+    uvicorn.run(create_app(sys.argv[1:]), host='0.0.0.0', port=args.port)